@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+"""
+ Copyright (c) 2011 Christiano F. Haesbaert <haesbaert@haesbaert.org>
+
+ Permission to use, copy, modify, and distribute this software for any
+ purpose with or without fee is hereby granted, provided that the above
+ copyright notice and this permission notice appear in all copies.
+
+ THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+ WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+ MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+ WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+ OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+"""
+Storage engine benchmarks.
+
+ bench.py run [-o results.json] [--engine sgbd2] [--keys N] [--ops N] ...
+ bench.py compare old.json new.json [--threshold 10]
+ bench.py readers [--keys N] [--ops N] [--procs N]
+
+run writes one result per (engine, buffer frames, workload) with throughput
+and latency percentiles, compare flags throughput drops and p99 increases
+above the threshold and exits with 1 if there are any.
+"""
+import os
+import sys
+import time
+import json
+import pickle
+import random
+import bisect
+import argparse
+
+import sgbd
+import sgbd2
+
+# Max key used for random keys
+MAXKEY = 4000000
+
+
+class Sgbd2Engine(object):
+    """Adapter for sgbd2.BplusTree.
+    """
+    name = "sgbd2"
+    clustered = False
+    compress = False
+
+    def __init__(self, path, frames):
+        """Set the buffer size and create a new tree. The buffer size is
+        module wide in sgbd2, it is put back by close.
+
+        Arguments:
+        - `path`: Datafile path
+        - `frames`: Number of buffer frames
+        """
+        self.saved = (sgbd2.MAXBUFFERLEN, sgbd2.BUFFERQUOTAS)
+        sgbd2.MAXBUFFERLEN = frames
+        # Keep the quota proportions of the default buffer
+        total = sum(DEFAULTQUOTAS.values())
+        sgbd2.BUFFERQUOTAS = dict((t, max(sgbd2.MINQUOTA, q * frames / total))
+                                  for (t, q) in DEFAULTQUOTAS.iteritems())
+        self.path = path
+        try:
+            self.tree = self.create(path)
+        except:
+            self.restore()
+            raise
+
+    def restore(self):
+        """Put back the buffer size of sgbd2.
+        """
+        sgbd2.MAXBUFFERLEN, sgbd2.BUFFERQUOTAS = self.saved
+
+    def create(self, path):
+        return sgbd2.BplusTree(path, clustered=self.clustered,
+                               compress=self.compress)
+
+    def insert(self, key, desc):
+        self.tree.insert(key, desc)
+
+    def lookup(self, key):
+        return self.tree.lookup(key)
+
+    def update(self, key, desc):
+        return self.tree.update(key, desc)
+
+    def scan(self, lo, hi):
+        return list(self.tree.scan(lo, hi))
+
+    def reopen(self):
+        """Close and load again, leaves an empty (cold) buffer.
+        """
+        self.tree.close()
+        self.tree = sgbd2.load_from_file(self.path + ".pickle")
+
+    def close(self):
+        try:
+            self.tree.close()
+        finally:
+            self.restore()
+
+
+class Sgbd2ClusteredEngine(Sgbd2Engine):
+    """Adapter for sgbd2.BplusTree with the records stored in the leaves.
+    """
+    name = "sgbd2-clustered"
+    clustered = True
+
+
+class Sgbd2ZlibEngine(Sgbd2Engine):
+    """Adapter for sgbd2.BplusTree with zlib compressed blocks.
+    """
+    name = "sgbd2-zlib"
+    compress = True
+
+
+class Sgbd2HashEngine(Sgbd2Engine):
+    """Adapter for sgbd2.HashIndex, it has no scan.
+    """
+    name = "sgbd2-hash"
+
+    def create(self, path):
+        return sgbd2.HashIndex(path)
+
+    def scan(self, lo, hi):
+        raise NotImplementedError("sgbd2.HashIndex has no scan")
+
+
+class SgbdEngine(object):
+    """Adapter for the older sgbd.Sgbd, it has no update nor scan. It only
+    handles the split of the root leaf, past a few hundred keys random
+    inserts fail and close cannot write the leaves back. Those workloads
+    end with an error, the others run on whatever got in.
+    """
+    name = "sgbd"
+
+    def __init__(self, path, frames):
+        """Set the buffer size and create a new database. The buffer size
+        is module wide in sgbd, it is put back by close.
+
+        Arguments:
+        - `path`: Datafile path
+        - `frames`: Number of buffer frames
+        """
+        self.saved = sgbd.MAXBUFFERLEN
+        sgbd.MAXBUFFERLEN = frames
+        if os.path.exists(path):
+            os.unlink(path)
+        self.path = path
+        try:
+            self.db = sgbd.Sgbd(path)
+        except:
+            self.restore()
+            raise
+
+    def restore(self):
+        """Put back the buffer size of sgbd.
+        """
+        sgbd.MAXBUFFERLEN = self.saved
+
+    def insert(self, key, desc):
+        self.db.insert(key, desc)
+
+    def lookup(self, key):
+        return self.db.lookup(key)
+
+    def update(self, key, desc):
+        raise NotImplementedError("sgbd has no update")
+
+    def scan(self, lo, hi):
+        raise NotImplementedError("sgbd has no scan")
+
+    def reopen(self):
+        """Close and load again, leaves an empty (cold) buffer.
+        """
+        self.db.close()
+        f = open(self.path + ".pickle")
+        self.db = pickle.load(f)
+        f.close()
+        self.db.fsh = open(self.path, "r+b", sgbd.BLOCKSIZE)
+
+    def close(self):
+        try:
+            self.db.close()
+        finally:
+            self.restore()
+
+
+DEFAULTQUOTAS = dict(sgbd2.BUFFERQUOTAS)
+ENGINES = {Sgbd2Engine.name: Sgbd2Engine,
+           Sgbd2ClusteredEngine.name: Sgbd2ClusteredEngine,
+           Sgbd2HashEngine.name: Sgbd2HashEngine,
+           Sgbd2ZlibEngine.name: Sgbd2ZlibEngine,
+           SgbdEngine.name: SgbdEngine}
+# Keys covered by one range scan
+SCANKEYS = 100
+
+
+class Zipf(object):
+    """Zipfian sampler over n items, item 0 is the most popular.
+    """
+
+    def __init__(self, n, s, rnd):
+        """Precompute the cumulative distribution.
+
+        Arguments:
+        - `n`: Number of items
+        - `s`: Skew, 1.0 is the classic zipf
+        - `rnd`: A random.Random
+        """
+        self.rnd = rnd
+        self.cdf = []
+        total = 0.0
+        for i in xrange(1, n + 1):
+            total = total + 1.0 / (i ** s)
+            self.cdf.append(total)
+        self.total = total
+
+    def sample(self):
+        """Return an item index.
+        """
+        return bisect.bisect_left(self.cdf, self.rnd.random() * self.total)
+
+
+def summarize(latencies, elapsed):
+    """Throughput and latency percentiles of a run.
+
+    Arguments:
+    - `latencies`: List of per operation seconds
+    - `elapsed`: Wall time of the run
+    """
+    lat = sorted(latencies)
+    n = len(lat)
+    def pct(p):
+        return lat[min(n - 1, int(n * p / 100.0))] if n else 0.0
+    return {"ops": n, "seconds": elapsed,
+            "ops_per_sec": n / elapsed if elapsed else 0.0,
+            "p50": pct(50), "p90": pct(90), "p99": pct(99),
+            "max": lat[-1] if n else 0.0}
+
+def timed(ops):
+    """Run a list of thunks, return the summary. An operation the engine
+    does not have, or one that fails, ends the workload with an "error"
+    entry in the summary of the operations done until then, the next
+    workloads still run.
+
+    Arguments:
+    - `ops`: List of callables
+    """
+    latencies = []
+    start = time.time()
+    try:
+        for op in ops:
+            t = time.time()
+            op()
+            latencies.append(time.time() - t)
+    except Exception, e:
+        summary = summarize(latencies, time.time() - start)
+        summary["error"] = repr(e)
+        return summary
+    return summarize(latencies, time.time() - start)
+
+def then(summary, step):
+    """Run step, the close or reopen of an engine after a workload, untimed.
+    If it fails the error goes in summary, the next workloads still run.
+
+    Arguments:
+    - `summary`: Summary of the workload
+    - `step`: Callable
+    """
+    try:
+        step()
+    except Exception, e:
+        summary.setdefault("error", "closing: {0!r}".format(e))
+    return summary
+
+def run_engine(engine_class, path, frames, nkeys, nops, rnd):
+    """Run every workload on a single engine and buffer size, yields
+    (workload, summary) pairs, summary has an "error" entry if the workload
+    failed.
+
+    Arguments:
+    - `engine_class`: One of ENGINES
+    - `path`: Datafile path
+    - `frames`: Number of buffer frames
+    - `nkeys`: Keys loaded before the read workloads
+    - `nops`: Operations per read/update workload
+    - `rnd`: A random.Random
+    """
+    def desc(k):
+        return "Descricao {0}".format(k)
+
+    # Sequential insert on its own tree
+    engine = engine_class(path, frames)
+    yield "seq_insert", then(timed([lambda k=k: engine.insert(k, desc(k))
+                                    for k in xrange(1, nkeys + 1)]),
+                             engine.close)
+
+    # Random insert, this tree is kept for the remaining workloads
+    engine = engine_class(path, frames)
+    keys = rnd.sample(xrange(1, MAXKEY), nkeys)
+    lookups = [rnd.choice(keys) for _ in xrange(nops)]
+    yield "rand_insert", then(timed([lambda k=k: engine.insert(k, desc(k))
+                                     for k in keys]), engine.reopen)
+
+    yield "lookup_cold", timed([lambda k=k: engine.lookup(k)
+                                for k in lookups])
+    yield "lookup_warm", timed([lambda k=k: engine.lookup(k)
+                                for k in lookups])
+
+    popular = list(keys)
+    rnd.shuffle(popular)
+    zipf = Zipf(len(popular), 1.0, rnd)
+    yield "lookup_zipf", timed([lambda k=popular[zipf.sample()]:
+                                    engine.lookup(k) for _ in xrange(nops)])
+
+    # Range scans of about SCANKEYS keys starting at a present key
+    ordered = sorted(keys)
+    span = MAXKEY / nkeys * SCANKEYS
+    yield "range_scan", timed([lambda k=k: engine.scan(k, k + span)
+                               for k in (rnd.choice(ordered)
+                                         for _ in xrange(nops / SCANKEYS + 1))])
+
+    yield "update", timed([lambda k=k: engine.update(k, desc(k + 1))
+                           for k in lookups])
+
+    # Mixed, writes are inserts of new keys
+    present = set(keys)
+    for ratio in (95, 50):
+        ops = []
+        for _ in xrange(nops):
+            if rnd.randrange(100) < ratio:
+                ops.append(lambda k=rnd.choice(keys): engine.lookup(k))
+            else:
+                k = rnd.randrange(1, MAXKEY)
+                while k in present:
+                    k = rnd.randrange(1, MAXKEY)
+                present.add(k)
+                ops.append(lambda k=k: engine.insert(k, desc(k)))
+        summary = timed(ops)
+        # The last workload closes the tree
+        if ratio == 50:
+            summary = then(summary, engine.close)
+        yield "mixed_{0}r".format(ratio), summary
+
+def run(args):
+    """The run command.
+
+    Arguments:
+    - `args`: Parsed arguments
+    """
+    results = []
+    for name in args.engine:
+        for frames in args.frames:
+            rnd = random.Random(args.seed)
+            workloads = run_engine(ENGINES[name], args.path, frames,
+                                   args.keys, args.ops, rnd)
+            while True:
+                try:
+                    workload, summary = workloads.next()
+                except StopIteration:
+                    break
+                except Exception, e:
+                    # The generator is gone, account the failure and move on
+                    results.append({"engine": name, "frames": frames,
+                                    "workload": "error", "error": repr(e)})
+                    sys.stderr.write("{0} frames {1}: {2!r}\n".format(
+                            name, frames, e))
+                    break
+                summary.update({"engine": name, "frames": frames,
+                                "workload": workload})
+                results.append(summary)
+                if "error" in summary:
+                    sys.stderr.write("{0:15s} {1:5d} {2:12s} after {3} ops: "
+                                     "{4}\n".format(name, frames, workload,
+                                                    summary["ops"],
+                                                    summary["error"]))
+                    continue
+                sys.stderr.write("{0:15s} {1:5d} {2:12s} {3:10.0f} ops/s "
+                                 "p50 {4:.6f} p99 {5:.6f}\n".format(
+                        name, frames, workload, summary["ops_per_sec"],
+                        summary["p50"], summary["p99"]))
+    doc = {"seed": args.seed, "keys": args.keys, "ops": args.ops,
+           "time": time.time(), "results": results}
+    if args.output == "-":
+        json.dump(doc, sys.stdout, indent=1, sort_keys=True)
+    else:
+        f = open(args.output, "w")
+        json.dump(doc, f, indent=1, sort_keys=True)
+        f.close()
+    return 0
+
+def compare(args):
+    """The compare command, flags throughput drops and p99 increases over
+    threshold percent.
+
+    Arguments:
+    - `args`: Parsed arguments
+    """
+    def load(path):
+        f = open(path)
+        doc = json.load(f)
+        f.close()
+        return dict(((r["engine"], r["frames"], r["workload"]), r)
+                    for r in doc["results"] if "error" not in r)
+    old, new = load(args.old), load(args.new)
+    regressions = 0
+    for key in sorted(set(old) & set(new)):
+        o, n = old[key], new[key]
+        dtput = 100.0 * (n["ops_per_sec"] - o["ops_per_sec"]) / \
+            (o["ops_per_sec"] or 1.0)
+        dp99 = 100.0 * (n["p99"] - o["p99"]) / (o["p99"] or 1.0)
+        flag = ""
+        if dtput < -args.threshold or dp99 > args.threshold:
+            flag = "REGRESSION"
+            regressions = regressions + 1
+        print("{0:15s} {1:5d} {2:12s} ops/s {3:+7.1f}% p99 {4:+7.1f}% {5}".format(
+                key[0], key[1], key[2], dtput, dp99, flag))
+    for key in sorted(set(old) ^ set(new)):
+        print("{0:15s} {1:5d} {2:12s} only in {3}".format(
+                key[0], key[1], key[2], args.old if key in old else args.new))
+    return 1 if regressions else 0
+
+def readers(args):
+    """The readers command, lookups/sec of a ReaderPool for 1..procs
+    processes.
+
+    Arguments:
+    - `args`: Parsed arguments
+    """
+    rnd = random.Random(args.seed)
+    keys = rnd.sample(xrange(1, MAXKEY), args.keys)
+    bp = sgbd2.BplusTree(args.path)
+    for k in keys:
+        bp.insert(k, "Descricao {0}".format(k))
+    bp.close()
+    lookups = [rnd.choice(keys) for _ in xrange(args.ops)]
+    procs = 1
+    while procs <= args.procs:
+        pool = sgbd2.ReaderPool(args.path + ".pickle", procs)
+        # Warm up the workers
+        pool.multi_get(lookups[:procs])
+        start = time.time()
+        pool.multi_get(lookups)
+        elapsed = time.time() - start
+        pool.close()
+        print("readers {0:3d} lookups/sec {1:10.0f}".format(
+                procs, args.ops / elapsed))
+        procs = procs * 2
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="sgbd benchmarks")
+    sub = parser.add_subparsers()
+
+    p = sub.add_parser("run", help="run the benchmark suite")
+    p.add_argument("-o", "--output", default="-",
+                   help="JSON results file, - for stdout")
+    p.add_argument("--engine", action="append", choices=sorted(ENGINES),
+                   help="engine to run, may be repeated, default sgbd2")
+    p.add_argument("--frames", type=int, action="append",
+                   help="buffer frames, may be repeated, default 256")
+    p.add_argument("--keys", type=int, default=5000)
+    p.add_argument("--ops", type=int, default=5000)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--path", default="bench.db")
+    p.set_defaults(func=run)
+
+    p = sub.add_parser("compare", help="compare two result files")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=10.0,
+                   help="percent change considered a regression")
+    p.set_defaults(func=compare)
+
+    p = sub.add_parser("readers", help="ReaderPool scaling")
+    p.add_argument("--keys", type=int, default=20000)
+    p.add_argument("--ops", type=int, default=100000)
+    p.add_argument("--procs", type=int, default=8)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--path", default="bench.db")
+    p.set_defaults(func=readers)
+
+    args = parser.parse_args(argv[1:])
+    if getattr(args, "engine", 0) is None:
+        args.engine = [Sgbd2Engine.name]
+    if getattr(args, "frames", 0) is None:
+        args.frames = [sgbd2.MAXBUFFERLEN]
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
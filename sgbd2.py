@@ -17,25 +17,170 @@
 """
 import os
 import time
+import mmap
+import math
 import struct
 import pickle
 import sys
 import types
 import random
+import bisect
+import heapq
+import zlib
+import collections
+import threading
+import multiprocessing
 
 BLOCKNUM          = 8192
 BLOCKSIZE         = 4096
 DATAFILESIZE      = BLOCKNUM * BLOCKSIZE
 MAXBUFFERLEN      = 256
-MAXBRANCHKEYS     = 400
-MAXBRANCHPOINTERS = MAXBRANCHKEYS + 1
-MAXLEAFKEYS       = 330
-MAXLEAFPOINTERS   = MAXLEAFKEYS + 1
-MAXRECORDS        = 64
+MAXPINNED         = 32
+PINLEVELS         = 2
+# Leaves: "H" keys, "HH" pointers, then the keys as varint deltas, each
+# key from the one before it (the first from 0)
+LEAFHEADER        = 2
+LEAFPOINTER       = 4
+# Branches: "H" keys, "=HI" children (blocknum, subtree keys), then the keys
+# as varint deltas
+BRANCHHEADER      = 2
+BRANCHCHILD       = 6
+# Longest varint, a 64 bit key
+MAXVARINT         = 10
+# Slotted record blocks: "HH" header (slots, payload start), a "HH" slot
+# (payload offset, length) per record, payloads ("Q" key + desc) packed
+# from the end of the block down
+RECORDHEADER      = 4
+RECORDSLOT        = 4
+RECORDSLACK       = 32
+# Descs longer than OVERFLOWDESC go to a chain of overflow blocks, each
+# with an "iH" header (next block or -1, bytes used), the slot payload is
+# "QiI" (key, first overflow block, desc length) and its length has
+# OVERFLOWFLAG set
+OVERFLOWDESC      = BLOCKSIZE / 8
+OVERFLOWHEADER    = 6
+OVERFLOWFLAG      = 0x8000
+PREFETCHBLOCKS    = 8
+PREFETCHGAP       = 4
+MAXREADAHEAD      = 64
 UNUSED            = 0
 LEAF              = 1
 BRANCH            = 2
 RECORD            = 3
+DATALEAF          = 4
+OVERFLOW          = 5
+BUCKET            = 6
+DIRECTORY         = 7
+# Hash buckets: "HH" header (local depth, entries), "QHH" entries
+MAXBUCKETKEYS     = (BLOCKSIZE - 4) / 12
+# Hash directory: "H" global depth, 2**depth "H" bucket numbers
+MAXDIRDEPTH       = 10
+MAXDATALEAFKEYS   = BLOCKSIZE / 64
+# Longest desc of a DataLeafBlock record, they are stored as "Q56s"
+DATALEAFDESC      = 56
+BLOCKTYPENAMES    = {UNUSED: "unused", LEAF: "leaf", BRANCH: "branch",
+                     RECORD: "record", DATALEAF: "dataleaf",
+                     OVERFLOW: "overflow", BUCKET: "bucket",
+                     DIRECTORY: "directory"}
+# Buffer partition of each block type, leaves of clustered trees and hash
+# buckets are leaves, the hash directory is a branch
+PARTITIONOF       = {LEAF: LEAF, BRANCH: BRANCH, RECORD: RECORD,
+                     DATALEAF: LEAF, BUCKET: LEAF, DIRECTORY: BRANCH}
+# Default buffer frame quota of each block type, adds up to MAXBUFFERLEN
+BUFFERQUOTAS      = {LEAF: 96, BRANCH: 32, RECORD: 128}
+MINQUOTA          = 8
+REBALANCEMISSES   = 256
+REBALANCESTEP     = 8
+# Desc bytes in a desc key, with the 24 bit crc it must stay under 63 bits
+DESCPREFIX        = 4
+# Blocks are handed out from extents of EXTENTBLOCKS contiguous blocks, each
+# extent holds a single block type
+EXTENTBLOCKS      = 32
+# Fraction of the entries the left block keeps when a split is caused by
+# an append at the right edge of the tree, other splits are 50/50
+SPLITFILL         = 1.0
+# Entries copied by each Compactor.step()
+COMPACTBATCH      = 1024
+# rebuild_index sorts the entries of REBUILDBLOCKS record blocks per run and
+# reads runs back RUNREAD entries at a time
+REBUILDBLOCKS     = 256
+RUNREAD           = 1024
+RUNENTRY          = struct.calcsize("=QHH")
+# Compressed blocks are packed in ZSECTOR byte sectors of path + ".z"
+ZSECTOR           = 512
+ZLEVEL            = 1
+HISTBUCKETS       = 32
+BLOOMBITS         = 1 << 20
+BLOOMHASHES       = 7
+
+# A block access event, as given to trace hooks. op is one of "get_block",
+# "load", "flush" or "alloc", hit is only meaningful for get_block, duration is
+# in seconds and victim is the blocknum evicted to make room, or None.
+TraceEvent = collections.namedtuple("TraceEvent", "op blocknum blocktype hit "
+                                    "duration victim")
+
+
+class Histogram(object):
+    """Latency histogram, bucket i counts samples under 2**i microseconds.
+    """
+
+    def __init__(self):
+        """Constructor, an empty histogram.
+        """
+        self.reset()
+
+    def reset(self):
+        """Zero all counters.
+        
+        Arguments:
+        - `self`:
+        """
+        self.buckets = [0] * HISTBUCKETS
+        self.count   = 0
+        self.total   = 0.0
+        self.max     = 0.0
+
+    def add(self, elapsed):
+        """Account a sample.
+        
+        Arguments:
+        - `self`:
+        - `elapsed`: Seconds
+        """
+        i = min(int(elapsed * 1000000).bit_length(), HISTBUCKETS - 1)
+        self.buckets[i] = self.buckets[i] + 1
+        self.count = self.count + 1
+        self.total = self.total + elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def percentile(self, pct):
+        """Upper bound, in seconds, of the bucket holding percentile pct.
+        
+        Arguments:
+        - `self`:
+        - `pct`: 0-100
+        """
+        if not self.count:
+            return 0.0
+        wanted = self.count * pct / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen = seen + n
+            if seen >= wanted:
+                return min((1 << i) / 1000000.0, self.max)
+        return self.max
+
+    def stats(self):
+        """Return a dict with count, total, mean, max, p50, p90 and p99.
+        
+        Arguments:
+        - `self`:
+        """
+        mean = self.total / self.count if self.count else 0.0
+        return {"count": self.count, "total": self.total, "mean": mean,
+                "max": self.max, "p50": self.percentile(50),
+                "p90": self.percentile(90), "p99": self.percentile(99)}
 
 
 class DataFile(object):
@@ -45,39 +190,509 @@ class DataFile(object):
     Dictionary is merged into this class, since they're closely related. 
     """
 
-    def __init__(self, path):
+    def __init__(self, path, compress=False):
         """DataFile constructor.
         
         Arguments:
         - `path`: DataFile file path, where block information is to be
         stored. 
+        - `compress`: Write blocks zlib compressed to path + ".z" when that
+        saves at least a ZSECTOR, read them back transparently
         """
         self.path = path
         # _blocks is a tuple of BLOCKNUM lists in the form [blocktype, full]
         self._blocks = tuple([[UNUSED, False, -1] for _ in xrange(BLOCKNUM)])
+        # Block type of each extent, None if not reserved, and the extent
+        # each block type is filling
+        self._extents = [None] * (BLOCKNUM / EXTENTBLOCKS)
+        self._open    = {}
+        # Bytes a new record payload can take, of every record block loaded
+        self._room    = {}
         # Zerout datafile
         if os.system("dd if=/dev/zero of={0} bs={1} count={2}".
                      format(self.path, BLOCKSIZE, BLOCKNUM)):
             raise ValueError("dd error")
+        # Compressed blocks, blocknum -> (first sector, compressed length),
+        # and the free sector runs of path + ".z", first sector -> length
+        # and end sector -> first sector, adjacent runs are always merged
+        self.compress   = compress
+        self._zmap      = {}
+        self._zfree     = {}
+        self._zfreeends = {}
+        self._zend      = 0
+        if compress:
+            open(self.path + ".z", "wb").close()
         # Open file
-        self.fh = open(self.path, "r+b", BLOCKSIZE)
+        self.fh         = None
+        self.zfh        = None
+        self._map       = None
+        self._readahead = None
+        self.readonly   = False
+        # Trace hooks, see subscribe()
+        self.hooks      = []
+        self.reset_stats()
+        self.open()
+
+    def subscribe(self, hook):
+        """Add a trace hook, hook(event) is called with a TraceEvent on every
+        get_block, block load, block flush and alloc. With no hooks attached
+        tracing costs a single test.
+        
+        Arguments:
+        - `self`:
+        - `hook`: A callable
+        """
+        self.hooks.append(hook)
+
+    def unsubscribe(self, hook):
+        """Remove a trace hook.
+        
+        Arguments:
+        - `self`:
+        - `hook`: A callable, previously subscribed
+        """
+        self.hooks.remove(hook)
+
+    def emit(self, op, blocknum, blocktype, hit=None, duration=0.0,
+             victim=None):
+        """Send a TraceEvent to every hook, callers should only call it if
+        there are hooks.
+        
+        Arguments:
+        - `self`:
+        - `op`: "get_block", "load", "flush" or "alloc"
+        - `blocknum`: Block number
+        - `blocktype`: Block type
+        - `hit`: True on a buffer hit, False on a miss
+        - `duration`: Seconds spent
+        - `victim`: Block number evicted, if any
+        """
+        event = TraceEvent(op, blocknum, blocktype, hit, duration, victim)
+        for hook in self.hooks:
+            hook(event)
+
+    def reset_stats(self):
+        """Zero all counters.
+        
+        Arguments:
+        - `self`:
+        """
+        self.allocs        = 0
+        self.frees         = 0
+        self.reads         = 0
+        self.bytes_read    = 0
+        self.writes        = 0
+        self.bytes_written = 0
+        self.fsyncs        = 0
+        self.fsync_time    = Histogram()
+        self.zreads        = 0
+        self.zwrites       = 0
+
+    def stats(self):
+        """Return a dict of cumulative counters.
+        
+        Arguments:
+        - `self`:
+        """
+        return {"allocs": self.allocs, "frees": self.frees,
+                "reads": self.reads,
+                "bytes_read": self.bytes_read, "writes": self.writes,
+                "bytes_written": self.bytes_written, "fsyncs": self.fsyncs,
+                "fsync_time": self.fsync_time.stats(),
+                "compressed": len(self._zmap), "zreads": self.zreads,
+                "zwrites": self.zwrites, "zsectors": self._zend,
+                "extents": len(self._extents) - self._extents.count(None)}
+
+    def __getstate__(self):
+        """Pickle support, file handles and mappings are not pickled.
+        
+        Arguments:
+        - `self`:
+        """
+        state = self.__dict__.copy()
+        state["fh"]         = None
+        state["zfh"]        = None
+        state["_map"]       = None
+        state["_readahead"] = None
+        state["hooks"]      = []
+        return state
+
+    def open(self, readonly=False):
+        """Open the backing file, a readonly DataFile maps the whole file
+        shared and never writes to it, so it can be opened from as many
+        processes as we like.
+        
+        Arguments:
+        - `self`:
+        - `readonly`: True to open a read-only shared mapping.
+        """
+        self.readonly   = readonly
+        # Blocks read ahead of time, blocknum -> data, oldest first
+        self._readahead = collections.OrderedDict()
+        if self.compress:
+            self.zfh = open(self.path + ".z", "rb" if readonly else "r+b")
+        if not readonly:
+            self.fh = open(self.path, "r+b", BLOCKSIZE)
+            return
+        self.fh   = open(self.path, "rb")
+        self._map = mmap.mmap(self.fh.fileno(), DATAFILESIZE,
+                              access=mmap.ACCESS_READ)
+
+    def close(self):
+        """Close the backing file and drop the mapping, if any.
+        
+        Arguments:
+        - `self`:
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        if self.zfh is not None:
+            self.zfh.close()
+            self.zfh = None
+
+    def compressed(self, blocknum):
+        """True if blocknum is stored compressed.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: Block number
+        """
+        return blocknum in self._zmap
+
+    def read_block(self, blocknum):
+        """Return the BLOCKSIZE bytes of block blocknum, on a readonly
+        DataFile this is a view straight into the mapping, no copy is made.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: Block number
+        """
+        offset = blocknum * BLOCKSIZE
+        if blocknum in self._zmap:
+            (sector, length) = self._zmap[blocknum]
+            self.reads      = self.reads + 1
+            self.zreads     = self.zreads + 1
+            self.bytes_read = self.bytes_read + length
+            self.zfh.seek(sector * ZSECTOR)
+            return zlib.decompress(self.zfh.read(length))
+        if self._map is not None:
+            return buffer(self._map, offset, BLOCKSIZE)
+        data = self._readahead.pop(blocknum, None)
+        if data is not None:
+            return data
+        self.reads      = self.reads + 1
+        self.bytes_read = self.bytes_read + BLOCKSIZE
+        self.fh.seek(offset)
+        return self.fh.read(BLOCKSIZE)
+
+    def readahead(self, blocknums):
+        """Read blocknums with as few reads as possible, the data is kept
+        until read_block asks for it, at most MAXREADAHEAD blocks are kept.
+        Near blocks are coalesced in a single read, holes of up to
+        PREFETCHGAP blocks are read and thrown away.
+        
+        Arguments:
+        - `self`:
+        - `blocknums`: Iterable of block numbers
+        """
+        # A mapping is already backed by the page cache
+        if self._map is not None:
+            return
+        # Compressed blocks are small reads of their own
+        wanted = sorted(set(b for b in blocknums if b not in self._readahead
+                            and b not in self._zmap))
+        fadvise = getattr(os, "posix_fadvise", None)
+        for start, end in self._runs(wanted):
+            count = end - start + 1
+            if fadvise is not None:
+                fadvise(self.fh.fileno(), start * BLOCKSIZE, count * BLOCKSIZE,
+                        os.POSIX_FADV_WILLNEED)
+            self.reads      = self.reads + 1
+            self.bytes_read = self.bytes_read + count * BLOCKSIZE
+            self.fh.seek(start * BLOCKSIZE)
+            data = self.fh.read(count * BLOCKSIZE)
+            for i in xrange(count):
+                if start + i in wanted:
+                    self._readahead[start + i] = \
+                        data[i * BLOCKSIZE:(i + 1) * BLOCKSIZE]
+        while len(self._readahead) > MAXREADAHEAD:
+            self._readahead.popitem(last=False)
+
+    def _runs(self, wanted):
+        """Coalesce sorted block numbers into [first, last] runs, holes of
+        up to PREFETCHGAP blocks are bridged.
+        
+        Arguments:
+        - `self`:
+        - `wanted`: Sorted list of block numbers
+        """
+        runs = []
+        for b in wanted:
+            if runs and b - runs[-1][1] <= PREFETCHGAP:
+                runs[-1][1] = b
+            else:
+                runs.append([b, b])
+        return runs
+
+    def willneed(self, blocknums):
+        """Get blocknums into the page cache in the background, with
+        posix_fadvise where there is one, else a daemon thread reads them
+        with file handles of its own and throws the data away. Returns the
+        thread, or None.
+        
+        Arguments:
+        - `self`:
+        - `blocknums`: Iterable of block numbers
+        """
+        blocknums = set(blocknums)
+        wanted    = sorted(b for b in blocknums if b not in self._zmap)
+        pieces    = [(start * BLOCKSIZE, (end - start + 1) * BLOCKSIZE)
+                     for start, end in self._runs(wanted)]
+        zpieces   = sorted((self._zmap[b][0] * ZSECTOR, self._zmap[b][1])
+                           for b in blocknums if b in self._zmap)
+        fadvise   = getattr(os, "posix_fadvise", None)
+        if fadvise is not None:
+            for (fh, todo) in ((self.fh, pieces), (self.zfh, zpieces)):
+                for offset, length in todo:
+                    fadvise(fh.fileno(), offset, length,
+                            os.POSIX_FADV_WILLNEED)
+            return None
+        files  = [(self.path, pieces)]
+        if zpieces:
+            files.append((self.path + ".z", zpieces))
+        thread = threading.Thread(target=_read_pieces, args=(files,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def write_block(self, blocknum, data):
+        """Write data to block blocknum, data is padded with zeroes up to
+        BLOCKSIZE.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: Block number
+        - `data`: String, at most BLOCKSIZE bytes
+        """
+        if self.readonly:
+            raise ValueError("write_block on a readonly DataFile")
+        if len(data) > BLOCKSIZE:
+            raise ValueError("Block {0} overflow, {1} bytes".format(
+                    blocknum, len(data)))
+        # Whatever we read ahead is now stale
+        self._readahead.pop(blocknum, None)
+        data = data.ljust(BLOCKSIZE, "\x00")
+        if self.compress and self._write_z(blocknum, data):
+            return
+        self._write_plain(blocknum, data)
+
+    def _write_plain(self, blocknum, data):
+        """Write BLOCKSIZE bytes of data uncompressed to block blocknum.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: Block number
+        - `data`: BLOCKSIZE bytes
+        """
+        self.writes        = self.writes + 1
+        self.bytes_written = self.bytes_written + BLOCKSIZE
+        self.fh.seek(blocknum * BLOCKSIZE)
+        self.fh.write(data)
+
+    def _write_z(self, blocknum, data):
+        """Write blocknum compressed to the sector heap if that saves at
+        least a sector, returns False (and drops any compressed copy) if
+        not.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: Block number
+        - `data`: BLOCKSIZE bytes
+        """
+        z       = zlib.compress(data, ZLEVEL)
+        sectors = (len(z) + ZSECTOR - 1) / ZSECTOR
+        self._zdrop(blocknum)
+        if sectors * ZSECTOR > BLOCKSIZE - ZSECTOR:
+            return False
+        sector = self._zalloc(sectors)
+        self._zmap[blocknum] = (sector, len(z))
+        self.writes        = self.writes + 1
+        self.zwrites       = self.zwrites + 1
+        self.bytes_written = self.bytes_written + len(z)
+        self.zfh.seek(sector * ZSECTOR)
+        self.zfh.write(z)
+        return True
+
+    def _zalloc(self, sectors):
+        """Take sectors from the smallest free run that has them, or from
+        the end of the sector heap. Returns the first sector.
+        
+        Arguments:
+        - `self`:
+        - `sectors`: Number of sectors
+        """
+        best = None
+        for (first, length) in self._zfree.iteritems():
+            if length >= sectors and \
+                    (best is None or length < self._zfree[best]):
+                best = first
+                if length == sectors:
+                    break
+        if best is None:
+            sector     = self._zend
+            self._zend = self._zend + sectors
+            return sector
+        length = self._zfree.pop(best)
+        del self._zfreeends[best + length]
+        if length > sectors:
+            self._zfree[best + sectors] = length - sectors
+            self._zfreeends[best + length] = best + sectors
+        return best
+
+    def _zdrop(self, blocknum):
+        """Forget the compressed copy of blocknum, if any, its sectors go
+        back to the free runs, merged with the ones next to them. A run
+        ending at the end of the heap shrinks the heap instead.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: Block number
+        """
+        old = self._zmap.pop(blocknum, None)
+        if old is None:
+            return
+        first = old[0]
+        end   = first + (old[1] + ZSECTOR - 1) / ZSECTOR
+        if end in self._zfree:
+            length = self._zfree.pop(end)
+            del self._zfreeends[end + length]
+            end = end + length
+        if first in self._zfreeends:
+            first = self._zfreeends.pop(first)
+            del self._zfree[first]
+        if end == self._zend:
+            self._zend = first
+            return
+        self._zfree[first]   = end - first
+        self._zfreeends[end] = first
+
+    def sync(self):
+        """Flush and fsync the backing file.
+        
+        Arguments:
+        - `self`:
+        """
+        start = time.time()
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        if self.zfh is not None:
+            self.zfh.flush()
+            os.fsync(self.zfh.fileno())
+        self.fsyncs = self.fsyncs + 1
+        self.fsync_time.add(time.time() - start)
 
-    def alloc(self, blocktype):
+    def alloc(self, blocktype, near=None):
         """Alloc a bloc, fetch an UNUSED block and change it's block type,
-        returning the number
+        returning the number. The block comes from the extent of near if it
+        has room, else from the extent blocktype is filling, else from a
+        newly reserved extent, so blocks of a type stay together.
         
         Arguments:
         - `self`:
         - `blocktype`: UNUSED, LEAF, RECORD, or BRANCH
+        - `near`: Block number the new block should follow, a sibling
+        """
+        self.allocs = self.allocs + 1
+        bnum = None
+        if near is not None:
+            bnum = self._unused_in(near / EXTENTBLOCKS, blocktype, near)
+        if bnum is None and blocktype in self._open:
+            bnum = self._unused_in(self._open[blocktype], blocktype)
+        if bnum is None:
+            ext = self._reserve(blocktype)
+            if ext is not None:
+                bnum = self._unused_in(ext, blocktype)
+        if bnum is None:
+            # Every extent is taken, any UNUSED block will do
+            for (b, (btype, _, _)) in enumerate(self._blocks):
+                if btype == UNUSED:
+                    bnum = b
+                    break
+            else:
+                raise ValueError("No more UNUSED blocks :-(")
+        self._blocks[bnum][0] = blocktype
+        self._blocks[bnum][1] = False
+        self._blocks[bnum][2] = -1
+        if self.hooks:
+            self.emit("alloc", bnum, blocktype)
+        return bnum
+
+    def _unused_in(self, ext, blocktype, after=None):
+        """First UNUSED block of extent ext, the ones past after first, None
+        if there is none or ext does not hold blocktype.
+        
+        Arguments:
+        - `self`:
+        - `ext`: Extent number
+        - `blocktype`: Block type
+        - `after`: Block number in ext
         """
-        for (bnum, (btype, _, _)) in enumerate(self._blocks):
-            if btype == UNUSED:
-                self._blocks[bnum][0] = blocktype
-                self._blocks[bnum][1] = False
-                self._blocks[bnum][2] = -1
+        if self._extents[ext] != blocktype:
+            return None
+        first = ext * EXTENTBLOCKS
+        order = xrange(first, first + EXTENTBLOCKS)
+        if after is not None:
+            order = range(after + 1, first + EXTENTBLOCKS) + \
+                range(first, after)
+        for bnum in order:
+            if self._blocks[bnum][0] == UNUSED:
                 return bnum
-        raise ValueError("No more UNUSED blocks :-(")
+        return None
+
+    def _reserve(self, blocktype):
+        """Reserve a free extent for blocktype, the one after the extent it
+        is filling if possible, and make it the one being filled. Returns
+        its number, None if no extent is free.
+        
+        Arguments:
+        - `self`:
+        - `blocktype`: Block type
+        """
+        def free(ext):
+            first = ext * EXTENTBLOCKS
+            return self._extents[ext] is None and \
+                all(self._blocks[b][0] == UNUSED
+                    for b in xrange(first, first + EXTENTBLOCKS))
+        candidates = xrange(len(self._extents))
+        if blocktype in self._open:
+            candidates = [self._open[blocktype] + 1] + list(candidates)
+        for ext in candidates:
+            if ext < len(self._extents) and free(ext):
+                self._extents[ext]    = blocktype
+                self._open[blocktype] = ext
+                return ext
+        return None
         
+    def release_extents(self):
+        """Forget the block type of every extent with no block in use, so
+        it can be reserved again for any type.
+        
+        Arguments:
+        - `self`:
+        """
+        for ext in xrange(len(self._extents)):
+            first = ext * EXTENTBLOCKS
+            if all(self._blocks[b][0] == UNUSED
+                   for b in xrange(first, first + EXTENTBLOCKS)):
+                self._extents[ext] = None
+        for (btype, ext) in self._open.items():
+            if self._extents[ext] is None:
+                del self._open[btype]
+
     def get_meta(self, blocknum):
         """Get the metadata for block blocknum.
         Returns a tuple like (type, fullness)
@@ -88,20 +703,35 @@ class DataFile(object):
         """
         return self._blocks[blocknum]
     
-    def get_notfull(self, blocktype):
-        """Get any block of type btype that is not full.
+    def get_notfull(self, blocktype, need=0):
+        """Get any block of type btype that is not full, and has room for
+        need bytes going by set_room.
         
         Arguments:
         - `self`:
         - `blocktype`: UNUSED, LEAF, RECORD, or BRANCH
+        - `need`: Bytes wanted
         """
         for (bnum, (btype, full, _)) in enumerate(self._blocks):
             if blocktype != btype:
                 continue
             if full:
                 continue
+            if need and self._room.get(bnum, need) < need:
+                continue
             
             return bnum
+
+    def set_room(self, blocknum, room):
+        """Remember how many bytes block blocknum has room for, so
+        get_notfull skips it without loading it.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: Block number
+        - `room`: Bytes
+        """
+        self._room[blocknum] = room
         
     def set_fullness(self, blocknum, fullness):
         """Set block number blocknum fullness to full (True) not full (False) 
@@ -137,21 +767,244 @@ class DataFile(object):
         #if blocknum < 1 or blocknum > 8191 or pblocknum < 1 or pblocknum > 8191:
         self._blocks[blocknum][2] = pblocknum
 
-            
+    def free(self, blocknum):
+        """Return blocknum to the UNUSED blocks, zeroing it on disk. A
+        compressed copy gives its sectors back.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: Block number
+        """
+        if self.readonly:
+            raise ValueError("free on a readonly DataFile")
+        self._readahead.pop(blocknum, None)
+        self._room.pop(blocknum, None)
+        self._zdrop(blocknum)
+        self._write_plain(blocknum, "\x00" * BLOCKSIZE)
+        self._blocks[blocknum][0] = UNUSED
+        self._blocks[blocknum][1] = False
+        self._blocks[blocknum][2] = -1
+        self.frees = self.frees + 1
+
+    def write_chain(self, data):
+        """Write data to a chain of new OVERFLOW blocks, returns the first
+        block number. Overflow blocks are never in the Buffer.
+        
+        Arguments:
+        - `self`:
+        - `data`: String
+        """
+        room   = BLOCKSIZE - OVERFLOWHEADER
+        chunks = [data[i:i + room] for i in xrange(0, len(data), room)]
+        blocks = []
+        for _ in chunks:
+            blocks.append(self.alloc(OVERFLOW, blocks[-1] if blocks else None))
+        for i, chunk in enumerate(chunks):
+            nxt = blocks[i + 1] if i + 1 < len(blocks) else -1
+            self.write_block(blocks[i],
+                             struct.pack("iH", nxt, len(chunk)) + chunk)
+        self.sync()
+        return blocks[0]
+
+    def read_chain(self, blocknum):
+        """Read the data of the OVERFLOW chain starting at blocknum.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: First block of the chain
+        """
+        chunks = []
+        while blocknum != -1:
+            data = self.read_block(blocknum)
+            blocknum, used = struct.unpack_from("iH", data, 0)
+            chunks.append(str(data[OVERFLOWHEADER:OVERFLOWHEADER + used]))
+        return ''.join(chunks)
+
+    def free_chain(self, blocknum):
+        """Free the OVERFLOW chain starting at blocknum.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: First block of the chain
+        """
+        while blocknum != -1:
+            (nxt, _) = struct.unpack_from("iH", self.read_block(blocknum), 0)
+            self.free(blocknum)
+            blocknum = nxt
+
+
+def _read_pieces(files):
+    """Read and drop (offset, length) pieces of files, the data is only
+    wanted in the page cache. Runs in the DataFile.willneed thread.
+    
+    Arguments:
+    - `files`: List of (path, list of (offset, length))
+    """
+    for path, pieces in files:
+        f = open(path, "rb")
+        for offset, length in pieces:
+            f.seek(offset)
+            f.read(length)
+        f.close()
+
+
+class BufferPartition(object):
+    """The frames of a single block type inside the Buffer, each partition
+    has a frame quota and its own eviction order.
+    """
+
+    def __init__(self, blocktype, quota):
+        """Constructor
+        
+        Arguments:
+        - `blocktype`: LEAF, RECORD, or BRANCH
+        - `quota`: Maximum number of frames
+        """
+        self.blocktype = blocktype
+        self.quota     = quota
+        self.frames    = {}
+        self.hits      = 0
+        self.misses    = 0
+        # Hits and misses since the last rebalance
+        self.whits     = 0
+        self.wmisses   = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def full(self):
+        """Check if the partition has used up its quota.
+        
+        Arguments:
+        - `self`:
+        """
+        return len(self.frames) >= self.quota
+
+    def victim(self):
+        """Return the least recently used block of this partition.
+        
+        Arguments:
+        - `self`:
+        """
+        victim = None
+        for b in self.frames.itervalues():
+            if victim is None or b.timestamp < victim.timestamp:
+                victim = b
+        return victim
+
+    def hit_rate(self):
+        """Hits over accesses, 0.0 if never accessed.
+        
+        Arguments:
+        - `self`:
+        """
+        if not self.hits + self.misses:
+            return 0.0
+        return float(self.hits) / (self.hits + self.misses)
+
+    def window_miss_rate(self):
+        """Miss rate since the last rebalance.
+        
+        Arguments:
+        - `self`:
+        """
+        if not self.whits + self.wmisses:
+            return 0.0
+        return float(self.wmisses) / (self.whits + self.wmisses)
+
+    def stats(self):
+        """Return a dict with occupancy, quota and hit rate.
+        
+        Arguments:
+        - `self`:
+        """
+        return {"quota": self.quota, "occupancy": len(self.frames),
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hit_rate()}
+
+
 class Buffer(object):
-    """The Buffer cache, holds at most 256 frames(blocks)
+    """The Buffer cache, holds at most 256 frames(blocks), split in one
+    partition per block type.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, maxpinned=MAXPINNED, quotas=None, adaptive=True,
+                 compress=False):
         """Constructor
         
         Arguments:
         - `self`:
         - `path`: Backstorage for this Buffer, a string.
+        - `maxpinned`: Frames reserved for pinned blocks, not counted in
+        MAXBUFFERLEN.
+        - `quotas`: Dict of blocktype -> frames, must add up to at most
+        MAXBUFFERLEN, defaults to BUFFERQUOTAS.
+        - `adaptive`: Move quota from the partition with the lowest miss rate
+        to the one with the highest, every REBALANCEMISSES misses.
+        - `compress`: Compress blocks on disk, see DataFile
         """
+        if quotas is None:
+            quotas = BUFFERQUOTAS
+        if sum(quotas.values()) > MAXBUFFERLEN:
+            raise ValueError("Buffer quotas exceed MAXBUFFERLEN")
         # self._frames   = []
-        self._frames = {}
-        self._datafile = DataFile(path)
+        self._frames    = {}
+        self._parts     = dict((t, BufferPartition(t, q))
+                               for (t, q) in quotas.iteritems())
+        self.adaptive   = adaptive
+        self._wmisses   = 0
+        # Pinned blocks live outside _frames and are never victimized
+        self._pinned    = {}
+        self.maxpinned  = maxpinned
+        self._datafile  = DataFile(path, compress)
+        self.reset_stats()
+        # Sequential miss detection, last missed blocknum and run length
+        self._lastmiss = -1
+        self._seqrun   = 0
+        # Read ahead window, [_rastart, _raend) blocks, _rasize 0 if none
+        self._rastart  = 0
+        self._raend    = 0
+        self._rasize   = 0
+
+    def reset_stats(self):
+        """Zero all counters, including the datafile and partition ones.
+        
+        Arguments:
+        - `self`:
+        """
+        self.hits        = 0
+        # Hits on pinned blocks, not in hits nor in any partition
+        self.pinned_hits = 0
+        self.misses      = 0
+        self.evictions   = 0
+        self.flushes     = 0
+        self.prefetches  = 0
+        self.miss_time   = Histogram()
+        self.flush_time  = Histogram()
+        for p in self._parts.itervalues():
+            p.hits   = 0
+            p.misses = 0
+        self._datafile.reset_stats()
+
+    def stats(self):
+        """Return a dict of cumulative counters, hit_rate counts the hits
+        on pinned blocks too.
+        
+        Arguments:
+        - `self`:
+        """
+        hits     = self.hits + self.pinned_hits
+        accesses = hits + self.misses
+        return {"hits": self.hits, "pinned_hits": self.pinned_hits,
+                "misses": self.misses,
+                "hit_rate": float(hits) / accesses if accesses else 0.0,
+                "evictions": self.evictions, "flushes": self.flushes,
+                "prefetches": self.prefetches,
+                "resident": len(self._frames), "pinned": len(self._pinned),
+                "get_block_miss": self.miss_time.stats(),
+                "flush": self.flush_time.stats(),
+                "partitions": self.partition_stats(),
+                "datafile": self._datafile.stats()}
 
     def full(self):
         """Check if buffer is full.
@@ -161,29 +1014,82 @@ class Buffer(object):
         """
         return len(self._frames) == MAXBUFFERLEN
 
-    def alloc(self, blocktype):
+    def alloc(self, blocktype, near=None):
         """Get new, unused block of blocktype
         
         Arguments:
         - `self`:
         - `blocktype`: Blocktype
+        - `near`: Block number the new block should be placed after
         """
-        blocknum = self._datafile.alloc(blocktype)
+        blocknum = self._datafile.alloc(blocktype, near)
         return self.get_block(blocknum)
     
-    def get_notfull(self, blocktype):
-        """Get any block object which isn't full of blocktype.
+    def get_notfull(self, blocktype, need=0):
+        """Get any block object which isn't full of blocktype, see
+        DataFile.get_notfull.
         
         Arguments:
         - `self`:
         - `blocktype`: UNUSED, LEAF, RECORD, or BRANCH
+        - `need`: Bytes wanted
         """
-        bnum = self._datafile.get_notfull(blocktype)
+        bnum = self._datafile.get_notfull(blocktype, need)
         if bnum is None:
             return self.alloc(blocktype)
         else:
             return self.get_block(bnum)
         
+    def prefetch(self, blocknums):
+        """Hint that blocknums will be needed soon, the ones not in a frame
+        are read ahead in batches.
+        
+        Arguments:
+        - `self`:
+        - `blocknums`: Iterable of block numbers
+        """
+        wanted = []
+        for b in blocknums:
+            if b in self._frames or b in self._pinned:
+                continue
+            (btype, _, _) = self._datafile.get_meta(b)
+            if btype != UNUSED:
+                wanted.append(b)
+        if wanted:
+            self.prefetches = self.prefetches + len(wanted)
+            self._datafile.readahead(wanted)
+
+    def _detect_sequential(self, blocknum):
+        """Called on every miss, after two misses on near blocks the next
+        PREFETCHBLOCKS blocks are read ahead. Nothing more is read until
+        the reader gets to the end of that window, then the next one is
+        read, twice as large up to MAXREADAHEAD blocks. Misses elsewhere in
+        between leave the window alone.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: The missed block number
+        """
+        inwindow = self._rasize and \
+            self._rastart <= blocknum < self._raend + PREFETCHGAP
+        if 0 < blocknum - self._lastmiss <= PREFETCHGAP:
+            self._seqrun = self._seqrun + 1
+        elif not inwindow:
+            self._seqrun = 0
+        self._lastmiss = blocknum
+        if inwindow:
+            if blocknum + 1 < self._raend:
+                return
+            size = min(self._rasize * 2, MAXREADAHEAD)
+        elif self._seqrun >= 2:
+            size = PREFETCHBLOCKS
+        else:
+            return
+        self._rastart = blocknum
+        self._raend   = min(blocknum + 1 + size, BLOCKNUM)
+        self._rasize  = size
+        self.prefetch(xrange(blocknum + 1, self._raend))
+
     def get_block(self, blocknum):
         """Get the block referenced from blocknum, make a
         victim if necessary, return the full, constructed block.
@@ -192,37 +1098,414 @@ class Buffer(object):
         - `self`:
         - `blocknum`: block number
         """
+        b = self._pinned.get(blocknum)
+        if b is not None:
+            self.pinned_hits = self.pinned_hits + 1
+            if self._datafile.hooks:
+                self._datafile.emit("get_block", blocknum, b.blocktype, True)
+            return b
         
         if self._frames.has_key(blocknum):
             b = self._frames[blocknum]
+            part = self._parts[PARTITIONOF[b.blocktype]]
+            part.hits  = part.hits + 1
+            part.whits = part.whits + 1
+            self.hits  = self.hits + 1
             b.touch()
+            if self._datafile.hooks:
+                self._datafile.emit("get_block", blocknum, b.blocktype, True)
             return b
         
-        if self.full():
-            victim = self._frames[self._frames.keys()[0]]
-            for i in self._frames:
-                b = self._frames[i]
-                if b.timestamp < victim.timestamp:
-                    victim = b
-            victim.flush()
-            self._frames.pop(victim.blocknum)
-            if self.full():
-                raise ValueError("Still full !")
+        start = time.time()
+        self.misses = self.misses + 1
         (btype, _, _) = self._datafile.get_meta(blocknum)
-        if btype == LEAF:
+        part = self._parts.get(PARTITIONOF.get(btype))
+        if part is None:
+            raise ValueError("get_block on invalid blocktype: {0}".format(btype))
+        part.misses  = part.misses + 1
+        part.wmisses = part.wmisses + 1
+        victim = self._make_room(part)
+        self._detect_sequential(blocknum)
+        b = self._construct(blocknum)
+        # Place buffer in frame (wire)
+        self._frames[blocknum] = b
+        part.frames[blocknum] = b
+        b.touch()
+        elapsed = time.time() - start
+        self.miss_time.add(elapsed)
+        if self._datafile.hooks:
+            self._datafile.emit("get_block", blocknum, btype, False, elapsed,
+                                victim)
+        if self.adaptive:
+            self._wmisses = self._wmisses + 1
+            if self._wmisses == REBALANCEMISSES:
+                self.rebalance()
+        return b
+
+    def _make_room(self, part):
+        """Make sure there is a free frame for a new block of part, the
+        victim comes from part if it is at its quota, otherwise from the
+        partition furthest above its own quota. Returns the victim blocknum,
+        or None.
+        
+        Arguments:
+        - `self`:
+        - `part`: A BufferPartition
+        """
+        victim = None
+        if part.full() and part.frames:
+            victim = self._evict(part)
+        if self.full():
+            over = max(self._parts.itervalues(),
+                       key=lambda p: len(p.frames) - p.quota)
+            victim = self._evict(over)
+            if self.full():
+                raise ValueError("Still full !")
+        return victim
+
+    def _evict(self, part):
+        """Victimize the least recently used frame of partition part, returns
+        the victim blocknum.
+        
+        Arguments:
+        - `self`:
+        - `part`: A BufferPartition
+        """
+        victim = part.victim()
+        self.evictions = self.evictions + 1
+        self._drop(victim)
+        self._frames.pop(victim.blocknum)
+        part.frames.pop(victim.blocknum)
+        return victim.blocknum
+
+    def rebalance(self):
+        """Move REBALANCESTEP frames of quota from the partition with the
+        lowest miss rate to the one with the highest, then start a new
+        measurement window. No partition goes below MINQUOTA.
+        
+        Arguments:
+        - `self`:
+        """
+        parts = sorted(self._parts.itervalues(),
+                       key=lambda p: p.window_miss_rate())
+        low, high = parts[0], parts[-1]
+        if low is not high and \
+                high.window_miss_rate() > low.window_miss_rate():
+            step = min(REBALANCESTEP, low.quota - MINQUOTA)
+            if step > 0:
+                low.quota  = low.quota - step
+                high.quota = high.quota + step
+        for p in parts:
+            p.whits   = 0
+            p.wmisses = 0
+        self._wmisses = 0
+
+    def partition_stats(self):
+        """Return a dict of blocktype name -> partition stats.
+        
+        Arguments:
+        - `self`:
+        """
+        return dict((BLOCKTYPENAMES[t], p.stats())
+                    for (t, p) in self._parts.iteritems())
+
+    def _drop(self, b):
+        """Flush a block which is leaving the buffer.
+        
+        Arguments:
+        - `self`:
+        - `b`: The block
+        """
+        # Blocks of a readonly datafile are never dirty, just drop them
+        if not self._datafile.readonly:
+            start = time.time()
+            b.flush()
+            elapsed = time.time() - start
+            self.flushes = self.flushes + 1
+            self.flush_time.add(elapsed)
+            if self._datafile.hooks:
+                self._datafile.emit("flush", b.blocknum, b.blocktype,
+                                    duration=elapsed)
+
+    def _construct(self, blocknum):
+        """Construct (and load) the block object for blocknum.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: block number
+        """
+        (btype, _, _) = self._datafile.get_meta(blocknum)
+        start = time.time()
+        if btype == LEAF:
             b = LeafBlock(self, blocknum)
         elif btype == RECORD:
             b = RecordBlock(self, blocknum)
         elif btype == BRANCH:
             b = BranchBlock(self, blocknum)
+        elif btype == DATALEAF:
+            b = DataLeafBlock(self, blocknum)
+        elif btype == BUCKET:
+            b = BucketBlock(self, blocknum)
+        elif btype == DIRECTORY:
+            b = DirectoryBlock(self, blocknum)
         else:
             raise ValueError("get_block on invalid blocktype: {0}".format(btype))
-        # Place buffer in frame (wire)
+        if self._datafile.hooks:
+            self._datafile.emit("load", blocknum, btype,
+                                duration=time.time() - start)
+        return b
+
+    def subscribe(self, hook):
+        """Add a trace hook, see DataFile.subscribe.
+        
+        Arguments:
+        - `self`:
+        - `hook`: A callable
+        """
+        self._datafile.subscribe(hook)
+
+    def unsubscribe(self, hook):
+        """Remove a trace hook.
+        
+        Arguments:
+        - `self`:
+        - `hook`: A callable, previously subscribed
+        """
+        self._datafile.unsubscribe(hook)
+
+    def pin(self, blocknum):
+        """Pin a block, pinned blocks are held in their own frames and are
+        never victimized. Returns False if there is no pinned frame left.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: block number
+        """
+        if blocknum in self._pinned:
+            return True
+        if len(self._pinned) == self.maxpinned:
+            return False
+        b = self._frames.pop(blocknum, None)
+        if b is None:
+            b = self._construct(blocknum)
+        else:
+            self._parts[PARTITIONOF[b.blocktype]].frames.pop(blocknum)
+        self._pinned[blocknum] = b
+        return True
+
+    def unpin(self, blocknum):
+        """Unpin a block, it goes back to the common frames.
+        
+        Arguments:
+        - `self`:
+        - `blocknum`: block number
+        """
+        b = self._pinned.pop(blocknum)
+        part = self._parts[PARTITIONOF[b.blocktype]]
+        self._make_room(part)
         self._frames[blocknum] = b
+        part.frames[blocknum] = b
         b.touch()
-        return b
 
+    def pinned(self):
+        """Return the list of pinned block numbers.
+        
+        Arguments:
+        - `self`:
+        """
+        return self._pinned.keys()
+
+    def resident(self):
+        """Return the block numbers in the frames, most recently used
+        first, pinned blocks are not included.
+        
+        Arguments:
+        - `self`:
+        """
+        return [b.blocknum for b in sorted(self._frames.itervalues(),
+                                           key=lambda b: b.timestamp,
+                                           reverse=True)]
+
+    def warm(self, blocknums, background=False):
+        """Load blocknums, as returned by resident(), into free frames.
+        The most recent ones are taken while their partition has quota
+        left, they are read in block number order MAXREADAHEAD at a time
+        and keep their recency order. Not accounted as hits or misses.
+        Returns the number of blocks loaded, or handed to the background
+        read.
+        
+        Arguments:
+        - `self`:
+        - `blocknums`: Block numbers, most recently used first
+        - `background`: Only get them into the page cache in the
+        background, see DataFile.willneed, the frames stay empty
+        """
+        now    = time.time()
+        used   = dict((t, len(p.frames)) for (t, p) in self._parts.iteritems())
+        # blocknum -> timestamp, older the further down the list
+        chosen = {}
+        for rank, bnum in enumerate(blocknums):
+            if bnum in self._frames or bnum in self._pinned or \
+                    bnum in chosen or bnum >= BLOCKNUM:
+                continue
+            (btype, _, _) = self._datafile.get_meta(bnum)
+            t = PARTITIONOF.get(btype)
+            if t is None or used[t] >= self._parts[t].quota:
+                continue
+            used[t]      = used[t] + 1
+            chosen[bnum] = now - rank * 1e-6
+        order = sorted(chosen)
+        if background:
+            self._datafile.willneed(order)
+            return len(order)
+        for i in xrange(0, len(order), MAXREADAHEAD):
+            chunk = order[i:i + MAXREADAHEAD]
+            self._datafile.readahead(chunk)
+            for bnum in chunk:
+                b = self._construct(bnum)
+                b.timestamp = chosen[bnum]
+                self._frames[bnum] = b
+                self._parts[PARTITIONOF[b.blocktype]].frames[bnum] = b
+        return len(order)
+
+    def save_warm(self):
+        """Write the resident block numbers, most recently used first, to
+        the datafile path + ".warm" for warm_up() after the next load.
+        Cheap, nothing is flushed, call it now and then so a crash leaves
+        a recent list.
+        
+        Arguments:
+        - `self`:
+        """
+        if self._datafile.readonly:
+            return
+        f = open(self._datafile.path + ".warm", "w")
+        pickle.dump(self.resident(), f)
+        f.close()
+
+    def warm_up(self, background=False):
+        """Reload the blocks listed by the last save_warm(), see warm().
+        
+        Arguments:
+        - `self`:
+        - `background`: Only get them into the page cache
+        """
+        path = self._datafile.path + ".warm"
+        if not os.path.exists(path):
+            return 0
+        f = open(path, "rb")
+        blocknums = pickle.load(f)
+        f.close()
+        return self.warm(blocknums, background)
+
+    def flush_all(self):
+        """Flush and drop every block, pinned or not.
+        
+        Arguments:
+        - `self`:
+        """
+        for b in self._frames.values() + self._pinned.values():
+            self._drop(b)
+        self._frames = {}
+        self._pinned = {}
+        for p in self._parts.itervalues():
+            p.frames = {}
+
+    
+def varint(n):
+    """Encode n >= 0 as a varint, 7 bits a byte, low bits first.
+    
+    Arguments:
+    - `n`: Integer
+    """
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n = n >> 7
+    out.append(n)
+    return str(out)
+
+def varint_len(n):
+    """Length of varint(n).
+    
+    Arguments:
+    - `n`: Integer
+    """
+    l = 1
+    while n >= 0x80:
+        n = n >> 7
+        l = l + 1
+    return l
+
+def encode_keys(keys):
+    """Encode sorted keys as varint deltas.
+    
+    Arguments:
+    - `keys`: Sorted list of integers
+    """
+    prev = 0
+    sl   = []
+    for k in keys:
+        sl.append(varint(k - prev))
+        prev = k
+    return ''.join(sl)
+
+def decode_keys(data, offset, count):
+    """Decode count keys encoded by encode_keys at offset of data.
+    
+    Arguments:
+    - `data`: String or buffer
+    - `offset`: Start of the encoded keys
+    - `count`: Number of keys
+    """
+    keys  = []
+    key   = 0
+    n     = 0
+    shift = 0
+    if not count:
+        return keys
+    for c in bytearray(data[offset:]):
+        n = n | ((c & 0x7F) << shift)
+        if c & 0x80:
+            shift = shift + 7
+            continue
+        key = key + n
+        keys.append(key)
+        if len(keys) == count:
+            break
+        n     = 0
+        shift = 0
+    return keys
+
+def keys_len(keys):
+    """Length of encode_keys(keys).
+    
+    Arguments:
+    - `keys`: Sorted list of integers
+    """
+    prev = 0
+    l    = 0
+    for k in keys:
+        l    = l + varint_len(k - prev)
+        prev = k
+    return l
+
+def insert_cost(keys, pos, key):
+    """Bytes encode_keys(keys) grows by when key is inserted at pos.
     
+    Arguments:
+    - `keys`: Sorted list of integers
+    - `pos`: Insert position of key
+    - `key`: Integer
+    """
+    prev = keys[pos - 1] if pos else 0
+    cost = varint_len(key - prev)
+    if pos < len(keys):
+        cost = cost + varint_len(keys[pos] - key) - \
+            varint_len(keys[pos] - prev)
+    return cost
+
+
 class Block(object):
     """Generic block class
     """
@@ -313,7 +1596,8 @@ class Block(object):
     
     
 class LeafBlock(Block):
-    """A Leaf block.
+    """A Leaf block, keys are delta encoded so fullness is in bytes: a leaf
+    is full when an entry with the longest delta may not fit.
     """
 
     def __init__(self, buf, blocknum):
@@ -326,6 +1610,8 @@ class LeafBlock(Block):
         Block.__init__(self, buf, blocknum, LEAF)
         self.keys     = []
         self.pointers = []
+        # Encoded size in bytes
+        self.size     = LEAFHEADER
         self.load()
         
     def load(self):
@@ -336,15 +1622,12 @@ class LeafBlock(Block):
         """
         if self.keys or self.pointers:
             raise ValueError("keys and pointers must be empty")
-        self._refresh_fullness()
-        fh = self._datafile.fh
-        fh.seek(self.offset())
-        for _ in xrange(MAXLEAFKEYS):
-            k, pb, po = struct.unpack("QHH", fh.read(12))
-            if k == 0:
-                continue
-            self.insert(k, (pb, po))
-        self._refresh_fullness()
+        data = self._datafile.read_block(self.blocknum)
+        (n,) = struct.unpack_from("H", data, 0)
+        p    = struct.unpack_from("{0}H".format(2 * n), data, LEAFHEADER)
+        self.pointers = zip(p[0::2], p[1::2])
+        self.keys     = decode_keys(data, LEAFHEADER + LEAFPOINTER * n, n)
+        self._resize()
 
     def flush(self):
         """Flush keys and pointers to disk.
@@ -352,41 +1635,55 @@ class LeafBlock(Block):
         Arguments:
         - `self`:
         """
-        fh = self._datafile.fh
-        fh.seek(self.offset())
-        # XXX use BLOCKSIZE instead of 4096
-        fh.write(struct.pack("4096s", "0"))
-        fh.seek(self.offset())
-        for i, k in enumerate(self.keys):
-            p = self.pointers[i]
-            s = struct.pack("QHH", k, p[0], p[1])
-            fh.write(s)
-        fh.flush()
-        os.fsync(fh.fileno())
+        sl = [struct.pack("H", len(self.keys))]
+        for p in self.pointers:
+            sl.append(struct.pack("HH", p[0], p[1]))
+        sl.append(encode_keys(self.keys))
+        self._datafile.write_block(self.blocknum, ''.join(sl))
+        self._datafile.sync()
         self.keys = []
         self.pointers = []
+
+    def _resize(self):
+        """Recompute the encoded size, then fullness.
+        
+        Arguments:
+        - `self`:
+        """
+        self.size = LEAFHEADER + LEAFPOINTER * len(self.keys) + \
+            keys_len(self.keys)
+        self._refresh_fullness()
     
-    # XXX this is wong
     def _refresh_fullness(self):
         """Refresh fullness
         
         Arguments:
         - `self`:
         """
-        self._datafile.set_fullness(self.blocknum,
-                                    len(self.keys) == MAXLEAFKEYS)
+        self._datafile.set_fullness(self.blocknum, self.size >
+                                    BLOCKSIZE - MAXVARINT - LEAFPOINTER)
 
-    def insert(self, key, pointer):
-        """Insert a record, leaf MUST NOT be full.
+    def _check(self, key, pointer):
+        """Type check a key and pointer about to be inserted.
         
         Arguments:
-        - `self`: 
-        - `rowid`: rowid to insert.
+        - `self`:
+        - `key`: pk
+        - `pointer`: rowid
         """
         if type(key) is not types.IntType:
             raise TypeError("Key not an integer")
         if type(pointer) is not types.TupleType:
             raise TypeError("Pointer not a tuple")
+
+    def insert(self, key, pointer):
+        """Insert a record, leaf MUST NOT be full.
+        
+        Arguments:
+        - `self`: 
+        - `rowid`: rowid to insert.
+        """
+        self._check(key, pointer)
         
         if self.full():
             raise ValueError("Leaf is already full you dumbass !")
@@ -397,22 +1694,38 @@ class LeafBlock(Block):
                 break
             pos = pos + 1
             
+        self.size = self.size + insert_cost(self.keys, pos, key) + LEAFPOINTER
         self.keys.insert(pos, key)
         self.pointers.insert(pos, pointer)
         self._refresh_fullness()
 
-    def insert_split(self, key, pointer, newleaf):
+    def remove(self, key):
+        """Remove key, returns its pointer or None if not there.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        """
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        self.keys.pop(i)
+        pointer = self.pointers.pop(i)
+        self.size = self.size - insert_cost(self.keys, i, key) - LEAFPOINTER
+        self._refresh_fullness()
+        return pointer
+
+    def insert_split(self, key, pointer, newleaf, fill=0.5):
         """Split the records with rightleaf, top-half records will go to
         newleaf.
         
         Arguments:
         - `self`:
         - `newleaf`: The new right(higher) leafblock.
+        - `fill`: Fraction of the entries kept in this leaf, at least one
+        goes to newleaf
         """
-        if type(key) is not types.IntType:
-            raise TypeError("Key not an integer")
-        if type(pointer) is not types.TupleType:
-            raise TypeError("Pointer not a tuple")
+        self._check(key, pointer)
         # can only split an already full leaf
         if not self.full():
             raise ValueError("Trying to split leaf which isn't full!")
@@ -427,18 +1740,104 @@ class LeafBlock(Block):
         self.pointers.insert(pos, pointer)
         
         # Do the splitting
-        for _ in xrange(0, len(self.keys)/2 + 1):
+        keep = max(1, min(len(self.keys) - 1, int(len(self.keys) * fill)))
+        for _ in xrange(keep, len(self.keys)):
             k = self.keys.pop()
             p = self.pointers.pop()
             newleaf.insert(k, p)
         
-        self._refresh_fullness()
-        newleaf._refresh_fullness()
-        assert not self.full()
+        self._resize()
+        newleaf._resize()
+        # This leaf may stay full after an uneven split
         assert not newleaf.full()
         # Return the middlekey and middle pointer
         return newleaf.keys[0], newleaf.pointers[0]
 
+class DataLeafBlock(LeafBlock):
+    """A Leaf block of a clustered tree, records live in the leaf itself,
+    pointers are the Record objects.
+    """
+
+    def __init__(self, buf, blocknum):
+        """Needs a buffer/datafile relation for metadata
+        
+        Arguments:
+        - `buf`: A Buffer Object
+        - `blocknum`: Blocknumber
+        """
+        Block.__init__(self, buf, blocknum, DATALEAF)
+        self.keys     = []
+        self.pointers = []
+        self.size     = 0
+        self.load()
+
+    def _resize(self):
+        """Records are fixed size, fullness is by count.
+        
+        Arguments:
+        - `self`:
+        """
+        self._refresh_fullness()
+
+    def _refresh_fullness(self):
+        """Refresh fullness
+        
+        Arguments:
+        - `self`:
+        """
+        self._datafile.set_fullness(self.blocknum,
+                                    len(self.keys) == MAXDATALEAFKEYS)
+
+    def load(self):
+        """Load records from disk.
+        
+        Arguments:
+        - `self`:
+        """
+        if self.keys or self.pointers:
+            raise ValueError("keys and pointers must be empty")
+        self._refresh_fullness()
+        data = self._datafile.read_block(self.blocknum)
+        for i in xrange(MAXDATALEAFKEYS):
+            k, desc = struct.unpack_from("Q{0}s".format(DATALEAFDESC), data,
+                                         i * 64)
+            if k == 0:
+                continue
+            r = Record(self.blocknum, i)
+            r.key  = k
+            r.desc = desc.split('\x00')[0]
+            self.insert(k, r)
+        self._refresh_fullness()
+
+    def flush(self):
+        """Flush records to disk.
+        
+        Arguments:
+        - `self`:
+        """
+        sl = []
+        for r in self.pointers:
+            sl.append(struct.pack("Q{0}s".format(DATALEAFDESC), r.key,
+                                  r.desc))
+        self._datafile.write_block(self.blocknum, ''.join(sl))
+        self._datafile.sync()
+        self.keys = []
+        self.pointers = []
+
+    def _check(self, key, pointer):
+        """Type check a key and record about to be inserted.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        - `pointer`: Record
+        """
+        if type(key) is not types.IntType:
+            raise TypeError("Key not an integer")
+        if not isinstance(pointer, Record):
+            raise TypeError("Pointer not a Record")
+
+
 class BranchBlock(Block):
     """A Branch block.
     """
@@ -455,6 +1854,10 @@ class BranchBlock(Block):
         self.keys     = []
         # Pointers are blocknums, len(keys) == (len(pointers) + 1)
         self.pointers = []
+        # Number of keys under each pointer
+        self.counts   = []
+        # Encoded size in bytes
+        self.size     = BRANCHHEADER
         self.load()
         
     def _refresh_fullness(self):
@@ -463,8 +1866,18 @@ class BranchBlock(Block):
         Arguments:
         - `self`:
         """
-        self._datafile.set_fullness(self.blocknum,
-                                    len(self.keys) == MAXBRANCHKEYS)
+        self._datafile.set_fullness(self.blocknum, self.size >
+                                    BLOCKSIZE - MAXVARINT - BRANCHCHILD)
+
+    def _resize(self):
+        """Recompute the encoded size, then fullness.
+        
+        Arguments:
+        - `self`:
+        """
+        self.size = BRANCHHEADER + BRANCHCHILD * len(self.pointers) + \
+            keys_len(self.keys)
+        self._refresh_fullness()
         
     def flush(self):
         """Flush keys and pointers to disk.
@@ -472,20 +1885,15 @@ class BranchBlock(Block):
         Arguments:
         - `self`:
         """
-        fh = self._datafile.fh
-        fh.seek(self.offset())
-        # XXX use BLOCKSIZE instead of 4096
-        fh.write(struct.pack("4096s", "0"))
-        fh.seek(self.offset())
-        for i, k in enumerate(self.keys):
-            l = self.pointers[i]
-            r = self.pointers[i+1]
-            s = struct.pack("QHH", k, l, r)
-            fh.write(s)
-        fh.flush()
-        os.fsync(fh.fileno())
+        sl = [struct.pack("H", len(self.keys))]
+        for p, c in zip(self.pointers, self.counts):
+            sl.append(struct.pack("=HI", p, c))
+        sl.append(encode_keys(self.keys))
+        self._datafile.write_block(self.blocknum, ''.join(sl))
+        self._datafile.sync()
         self.keys = []
         self.pointers = []
+        self.counts = []
         
     def load(self):
         """Load keys and pointers from disk.
@@ -495,192 +1903,102 @@ class BranchBlock(Block):
         """
         if self.keys or self.pointers:
             raise ValueError("keys and pointers must be empty")
-        self._refresh_fullness()
-        fh = self._datafile.fh
-        fh.seek(self.offset())
-        for _ in xrange(MAXBRANCHKEYS):
-            k, l, r = struct.unpack("QHH", fh.read(12))
-            if k == 0:
-                continue
-            self.new_insert(l, k, r)
-        self._refresh_fullness()
+        data = self._datafile.read_block(self.blocknum)
+        (n,) = struct.unpack_from("H", data, 0)
+        if n:
+            children      = struct.unpack_from("=" + "HI" * (n + 1), data,
+                                               BRANCHHEADER)
+            self.pointers = list(children[0::2])
+            self.counts   = list(children[1::2])
+            self.keys     = decode_keys(data, BRANCHHEADER +
+                                        BRANCHCHILD * (n + 1), n)
+        self._resize()
 
-    def new_insert(self, leftblocknum, key, rightblocknum):
+    def new_insert(self, pos, leftblocknum, key, rightblocknum, leftcount,
+                   rightcount):
+        """Insert key and rightblocknum after leftblocknum, setting the key
+        counts of both. The position comes from the caller, with duplicate
+        keys a search on key may find the wrong child.
+        
+        Arguments:
+        - `self`:
+        - `pos`: Position of leftblocknum in this branch, 0 if it is empty
+        - `leftblocknum`: Pointer to left block, already in this branch
+        unless it is empty
+        - `key`: The key, pk
+        - `rightblocknum`: Pointer to right block
+        - `leftcount`: Keys under leftblocknum
+        - `rightcount`: Keys under rightblocknum
+        """
         if self.full():
             raise ValueError("Branch is already full you dumbass !")
-        pos = 0
-        for k in self.keys:
-            if k > key:
-                break
-            pos = pos + 1
+        if self.pointers and self.pointers[pos] != leftblocknum:
+            raise ValueError("Left pointer {0} not at {1}".format(
+                    leftblocknum, pos))
+        self.size = self.size + insert_cost(self.keys, pos, key) + BRANCHCHILD
         self.keys.insert(pos, key)
 
         if not self.pointers:
+            self.size = self.size + BRANCHCHILD
             self.pointers.append(leftblocknum)
             self.pointers.append(rightblocknum)
+            self.counts = [leftcount, rightcount]
         else:
-            # if self.pointers[pos] != leftblocknum:
-            #     raise ValueError("Deu merda {0} {1}".format(
-            #             self.pointers[pos], leftblocknum))
             self.pointers.insert(pos + 1, rightblocknum)
+            self.counts[pos] = leftcount
+            self.counts.insert(pos + 1, rightcount)
 
         self._refresh_fullness()
 
-    def new_insert_split(self, leftblocknum, key, rightblocknum, newindex):
+    def new_insert_split(self, pos, leftblocknum, key, rightblocknum,
+                         leftcount, rightcount, newindex, fill=0.5):
+        """Insert key and rightblocknum into this full branch and move the
+        top half to newindex, the middle key is removed from both and
+        returned to be inserted in the parent, together with newindex
+        blocknum.
+        
+        Arguments:
+        - `self`:
+        - `pos`: Position of leftblocknum in this branch
+        - `leftblocknum`: Pointer to left block, already in this branch
+        - `key`: The key, pk
+        - `rightblocknum`: Pointer to right block
+        - `leftcount`: Keys under leftblocknum
+        - `rightcount`: Keys under rightblocknum
+        - `newindex`: The new, empty, right(higher) branch
+        - `fill`: Fraction of the keys kept in this branch, at least one
+        goes to newindex
+        """
         if not self.full():
             raise ValueError("Branch isn't full !")
 
-        print ("new_insert_split {0} {1} {2}".format(leftblocknum, key, rightblocknum))
-        pos = 0
-        for k in self.keys:
-            if k > key:
-                break
-            pos = pos + 1
-        self.keys.insert(pos, key)
-
-        if not self.pointers:
-            self.pointers.append(leftblocknum)
-            self.pointers.append(rightblocknum)
-        else:
-            # if self.pointers[pos] != leftblocknum:
-            #     raise ValueError("Deu merda {0} {1}".format(
-            #             self.pointers[pos], leftblocknum))
-            self.pointers.insert(pos + 1, rightblocknum)
-            self.pointers[pos] = leftblocknum
-            #self.pointers.insert(pos + 1, rightblocknum)
-
-        print (self.keys)
-        print (self.pointers)
-        
-        # for _ in xrange(0, len(self.keys)/2 + 1):
-        #     k = self.keys.pop()
-        #     p = self.pointers.pop()
-        #     p2 = self.pointers[0]
-        #     newindex.new_insert(p, k, p2)
-
-        # split antes, keys eh impar, pointers eh par
-        tmp_selfkeys = self.keys[:len(self.keys)/2+1]
-        tmp_selfpointers = self.pointers[:len(self.pointers)/2+1]
-        if len(tmp_selfkeys) + 1!= len(tmp_selfpointers) :
-            raise ValueError("tmp_selfkeys {0} != tmp_selfpointers {1}"
-                             .format(len(tmp_selfkeys), len(tmp_selfpointers)))
-        
-        # Top half
-        newindex.keys = self.keys[len(self.keys)/2+1:]
-        newindex.pointers = self.pointers[len(self.pointers)/2:]
-        if len(newindex.keys) + 1 != len(newindex.pointers):
-            raise ValueError("newindex.keys {0} != newindex.pointers {1}"
-                             .format(len(newindex.keys), len(newindex.pointers)))
-
-        print("newindex keys", newindex.keys)
-        print("newindex pointers", newindex.pointers)
-        # tiro a middlekey
-        indexmiddlekey  = newindex.keys.pop(0)
-        indexmiddlepointer = newindex.pointers.pop(0) # ou 1 ?
-        # copia do tmp
-        self.keys = tmp_selfkeys
-        self.pointers = tmp_selfpointers
-        
-        self._refresh_fullness()
-        newindex._refresh_fullness()
-
-        print("index {0} newindex {1}".format(self.blocknum, newindex.blocknum))
-        print("indexmiddlekey = {0}, indexmiddlepointer = {1}".format(
-                indexmiddlekey, indexmiddlepointer
-                ))
-        
-        indexmiddlepointer = rightblocknum
-        return indexmiddlekey, indexmiddlepointer
-        
-        
-    def _insert(self, leftblocknum, key, rightblocknum):
-        """Insert new leaf a pointers
-        
-        Arguments:
-        - `self`:
-        - `leftblocknum`: Pointer to left block
-        - `key`: The key, pk
-        - `rightblocknum`: Pointer to right block
-        """
-        if self.full():
-            raise ValueError("Branch is already full you dumbass !")
-        pos = 0
-        for k in self.keys:
-            if k > key:
-                break
-            pos = pos + 1
+        if self.pointers[pos] != leftblocknum:
+            raise ValueError("Left pointer {0} not at {1}".format(
+                    leftblocknum, pos))
         self.keys.insert(pos, key)
-        self.pointers.insert(pos, leftblocknum)
         self.pointers.insert(pos + 1, rightblocknum)
-        self._refresh_fullness()
-
-    def insert_split(self, lleaf, leafmiddlekey, rleaf, newindex):
-        """
-        
-        Arguments:
-        - `self`:
-        """
+        self.counts[pos] = leftcount
+        self.counts.insert(pos + 1, rightcount)
 
-        # leafmiddlekey = 85
-        # lleaf = 75,80
-        # rleaf = 85,90,95...
-        # INSERE O LEAFMIDDLE-KEY, AE FAZ O SPLIT, DEPOIS VE ONDE TA O MIDDLEKEY E
-        #SETA O RLEAF PARENT PRA ONDE TA O MIDDLE-KEY
-        
-        pos = 0
-        for k in self.keys:
-            if k > leafmiddlekey:
-                break
-            pos = pos + 1
-        self.keys.insert(pos, leafmiddlekey)
-        self.pointers.insert(pos, lleaf.blocknum)
-        self.pointers.insert(pos + 1, rleaf.blocknum)
-        
-        #self.pointers.insert(pos, pointer)
-        # Do the splitting
-        for _ in xrange(0, len(self.keys)/2 + 1):
-            k = self.keys.pop()
-            p = self.pointers.pop()
-            newindex.insert(p, k, self.pointers[0])
+        # keys[mid] goes up, everything above it goes to newindex
+        mid               = max(1, min(len(self.keys) - 2,
+                                       int(len(self.keys) * fill)))
+        middlekey         = self.keys[mid]
+        newindex.keys     = self.keys[mid + 1:]
+        newindex.pointers = self.pointers[mid + 1:]
+        newindex.counts   = self.counts[mid + 1:]
+        self.keys         = self.keys[:mid]
+        self.pointers     = self.pointers[:mid + 1]
+        self.counts       = self.counts[:mid + 1]
+        for child in newindex.pointers:
+            self._datafile.set_parent(child, newindex.blocknum)
 
-        middlekey = newindex.keys.pop(0)
-        self._refresh_fullness()
-        newindex._refresh_fullness()
+        self._resize()
+        newindex._resize()
 
-        if lleaf.blocknum in self.pointers:
-            print("left leaf {0} in self {1}".format(lleaf.blocknum, self.blocknum))
-        else:
-            print("left leaf {0} in newindex {1}".format(lleaf.blocknum, newindex.blocknum))
-            
-        if rleaf.blocknum in self.pointers:
-            print("left leaf {0} in self {1}".format(rleaf.blocknum, self.blocknum))
-        else:
-            print("left leaf {0} in newindex {1}".format(rleaf.blocknum, newindex.blocknum))
-        
-        # # Search leafmiddlekey to fix parent pointer
-        # if leafmiddlekey in self.keys:
-        #     rleaf.set_parent(self)
-        # elif leafmiddlekey in newindex.keys:
-        #     rleaf.set_parent(newindex)
-        # else:
-        #     raise ValueError("Fudeu")
-        
-        return middlekey, (self.blocknum, newindex.blocknum)
-        
-        
-        # middlekey_pos = len(self.keys)/2
-        # middlekey = self.keys.pop(middlekey_pos)
-        # # Do the splitting
-        # for i in xrange(0, middlekey_pos - 1):
-        #     k = self.keys.pop(middlekey_pos)
-        #     newindex.keys.append(k)
-        #     # #p = self.pointers.pop()
-        #     # newleaf.insert(k, p)
+        return middlekey, newindex.blocknum
 
 
-        # return middlekey
-    
-        
 class Record(object):
     """A data record
     """
@@ -696,10 +2014,36 @@ class Record(object):
         self.offset   = offset
         self.key      = 0
         self.desc     = "Free"
+        # (datafile, first block, length) of a desc in overflow blocks
+        self.overflow = None
+
+    def _get_desc(self):
+        if self._desc is None:
+            (datafile, first, _) = self.overflow
+            self._desc = datafile.read_chain(first)
+        return self._desc
+
+    def _set_desc(self, desc):
+        self._desc = desc
+
+    desc = property(_get_desc, _set_desc)
+
+    def __getstate__(self):
+        """Pickle support, an overflow desc is read in and kept.
         
+        Arguments:
+        - `self`:
+        """
+        state = dict(self.__dict__)
+        state["_desc"]    = self.desc
+        state["overflow"] = None
+        return state
+
 
 class RecordBlock(Block):
-    """A Record block, may contain up to 64 records
+    """A Record block, a slotted page of variable length records. Records
+    are addressed by slot number, which stays valid when the payloads move.
+    Long descs are kept in a chain of overflow blocks, read on first use.
     """
 
     def __init__(self, buf, blocknum):
@@ -710,23 +2054,84 @@ class RecordBlock(Block):
         - `blocknum`: Blocknumber
         """
         Block.__init__(self, buf, blocknum, RECORD)
-        self.records = []
+        self.records    = []
+        self._freeslots = []
+        self.freespace  = BLOCKSIZE - RECORDHEADER
         self.load()
+
+    @staticmethod
+    def payload(desc):
+        """Bytes a record of desc takes in the block, slot not included.
+        
+        Arguments:
+        - `desc`: Record desc
+        """
+        if len(desc) > OVERFLOWDESC:
+            return 16
+        return 8 + len(desc)
+
+    def _payload_of(self, r):
+        """Bytes record r takes in the block, without reading an overflow
+        desc.
+        
+        Arguments:
+        - `self`:
+        - `r`: Record of this block
+        """
+        if r.overflow is not None:
+            return 16
+        return self.payload(r.desc)
+
+    def _store(self, r, desc):
+        """Set the desc of r, spilling it to overflow blocks if it is long.
+        
+        Arguments:
+        - `self`:
+        - `r`: Record of this block
+        - `desc`: Record desc
+        """
+        r.desc     = desc
+        r.overflow = None
+        if len(desc) > OVERFLOWDESC:
+            r.overflow = (self._datafile,
+                          self._datafile.write_chain(desc), len(desc))
+
+    def _release(self, r):
+        """Free the overflow blocks of r, if any.
+        
+        Arguments:
+        - `self`:
+        - `r`: Record of this block
+        """
+        if r.overflow is not None:
+            self._datafile.free_chain(r.overflow[1])
+            r.overflow = None
+
+    def fits(self, desc):
+        """True if a record of desc fits in this block.
+        
+        Arguments:
+        - `self`:
+        - `desc`: Record desc
+        """
+        need = self.payload(desc)
+        if not self._freeslots:
+            need = need + RECORDSLOT
+        return need <= self.freespace
         
     def _refresh_fullness(self):
-        """Refresh fullness
+        """Refresh fullness, a block is full when not even a short record
+        fits, and the room left for a new record payload.
         
         Arguments:
         - `self`:
         """
-        full = True
-        # Find at least one free record
-        for r in self.records:
-            if r.key == 0:
-                full = False
-                break
-            
-        self._datafile.set_fullness(self.blocknum, full)
+        self._datafile.set_fullness(self.blocknum,
+                                    self.freespace < RECORDSLACK)
+        room = self.freespace
+        if not self._freeslots:
+            room = room - RECORDSLOT
+        self._datafile.set_room(self.blocknum, room)
 
     def alloc(self, key, desc):
         """Alloc a new record on this RecordBlock, return the record.
@@ -736,16 +2141,53 @@ class RecordBlock(Block):
         - `key`: Record key
         - `desc`: Record desc
         """
-        if self.full():
-            raise ValueError("RecordBlock already full !")
-        for r in self.records:
-            # If record is free...
-            if r.key == 0:
-                r.key  = key
-                r.desc = desc
-                self._refresh_fullness()
-                return r
-        raise ValueError("Should have found a free record")
+        if not self.fits(desc):
+            raise ValueError("Record does not fit in RecordBlock !")
+        if self._freeslots:
+            r = self.records[self._freeslots.pop()]
+        else:
+            r = Record(self.blocknum, len(self.records))
+            self.records.append(r)
+            self.freespace = self.freespace - RECORDSLOT
+        r.key = key
+        self._store(r, desc)
+        self.freespace = self.freespace - self.payload(desc)
+        self._refresh_fullness()
+        return r
+
+    def resize(self, offset, desc):
+        """Replace the desc of the record at offset, False if the new desc
+        does not fit in this block.
+        
+        Arguments:
+        - `self`:
+        - `offset`: Record offset
+        - `desc`: New record desc
+        """
+        r = self.records[offset]
+        grow = self.payload(desc) - self._payload_of(r)
+        if grow > self.freespace:
+            return False
+        self.freespace = self.freespace - grow
+        self._release(r)
+        self._store(r, desc)
+        self._refresh_fullness()
+        return True
+
+    def free(self, offset):
+        """Free the record at offset.
+        
+        Arguments:
+        - `self`:
+        - `offset`: Record offset
+        """
+        r = self.records[offset]
+        self.freespace = self.freespace + self._payload_of(r)
+        self._release(r)
+        r.key  = 0
+        r.desc = "Free"
+        self._freeslots.append(offset)
+        self._refresh_fullness()
 
     def load(self):
         """Load records from disk.
@@ -755,283 +2197,2575 @@ class RecordBlock(Block):
         """
         if self.records:
             raise ValueError("records must be empty")
-        self._refresh_fullness()
-        fh = self._datafile.fh
-        fh.seek(self.offset())
-        for x in xrange(MAXRECORDS):
-            k, desc = struct.unpack("Q56s", fh.read(64))
+        data = self._datafile.read_block(self.blocknum)
+        nslots, _ = struct.unpack_from("HH", data, 0)
+        self.freespace = BLOCKSIZE - RECORDHEADER - nslots * RECORDSLOT
+        for x in xrange(nslots):
+            off, length = struct.unpack_from("HH", data,
+                                             RECORDHEADER + x * RECORDSLOT)
             r = Record(self.blocknum, x)
-            r.key = k
-            r.desc = desc.split('\x00')[0]
+            if off and length & OVERFLOWFLAG:
+                (r.key, first, dlen) = struct.unpack_from("QiI", data, off)
+                r.desc     = None
+                r.overflow = (self._datafile, first, dlen)
+                self.freespace = self.freespace - 16
+            elif off:
+                (r.key,) = struct.unpack_from("Q", data, off)
+                r.desc = str(data[off + 8:off + length])
+                self.freespace = self.freespace - length
+            else:
+                r.desc = "Free"
+                self._freeslots.append(x)
             self.records.append(r)
+        self._freeslots.reverse()
         self._refresh_fullness()
 
     def flush(self):
-        """Flush records.
+        """Flush records, payloads are written packed, so holes left by
+        freed or resized records are compacted away.
         
         Arguments:
         - `self`:
         """
-        fh = self._datafile.fh
-        fh.seek(self.offset())
-        # XXX use BLOCKSIZE instead of 4096
-        fh.write(struct.pack("4096s", "0"))
-        fh.seek(self.offset())
+        slots    = []
+        payloads = []
+        start    = BLOCKSIZE
         for r in self.records:
-            s = struct.pack("Q56s", r.key, r.desc)
-            fh.write(s)
-        fh.flush()
-        os.fsync(fh.fileno())
-        self.records = []
+            if r.key == 0:
+                slots.append(struct.pack("HH", 0, 0))
+                continue
+            if r.overflow is not None:
+                payload = struct.pack("QiI", r.key, r.overflow[1],
+                                      r.overflow[2])
+                flag = OVERFLOWFLAG
+            else:
+                payload = struct.pack("Q", r.key) + r.desc
+                flag = 0
+            start = start - len(payload)
+            slots.append(struct.pack("HH", start, len(payload) | flag))
+            payloads.append(payload)
+        payloads.reverse()
+        head = struct.pack("HH", len(self.records), start) + ''.join(slots)
+        body = ''.join(payloads)
+        self._datafile.write_block(self.blocknum,
+            head + '\x00' * (BLOCKSIZE - len(head) - len(body)) + body)
+        self._datafile.sync()
+        self.records    = []
+        self._freeslots = []
         
         
-class BplusTree(object):
-    """A B+ Tree object, this where the shit happens.
+class BucketBlock(Block):
+    """A hash bucket, unordered (key, pointer) entries of the keys whose
+    hash ends with the same depth bits.
     """
 
-    def __init__(self, path):
-        """Create a new BplusTree, needs a buf to fetch/store blocks
+    def __init__(self, buf, blocknum):
+        """Needs a buffer/datafile relation for metadata
         
         Arguments:
-        - `path`: Buffer storage path
-        - `rootnum`: Number of root block
+        - `buf`: A Buffer Object
+        - `blocknum`: Blocknumber
         """
-        self._buf    = Buffer(path)
-        self.path    = path
-        # Make sure root is there.
-        root         = self._buf.alloc(LEAF)
-        self.rootnum = root.blocknum
+        Block.__init__(self, buf, blocknum, BUCKET)
+        self.depth   = 0
+        self.entries = {}
+        self.load()
 
-    def close(self):
-        """Save all state to disk
+    def _refresh_fullness(self):
+        """Refresh fullness
         
         Arguments:
         - `self`:
         """
-        for i in self._buf._frames:
-            b = self._buf._frames[i]
-            b.flush()
-        f = open(self._buf._datafile.path + ".pickle", "w")
-        self._buf._frames = {}
-        self._buf._datafile.fh.close()
-        self._buf._datafile.fh = None
-        pickle.dump(self, f)
-        f.close()
-        del self
-    
-    def get_root(self):
-        """Fetch root block
+        self._datafile.set_fullness(self.blocknum,
+                                    len(self.entries) == MAXBUCKETKEYS)
+
+    def load(self):
+        """Load entries from disk.
         
         Arguments:
         - `self`:
         """
-        return self._buf.get_block(self.rootnum)
+        if self.entries:
+            raise ValueError("entries must be empty")
+        data = self._datafile.read_block(self.blocknum)
+        self.depth, n = struct.unpack_from("HH", data, 0)
+        for i in xrange(n):
+            k, rb, ro = struct.unpack_from("QHH", data, 4 + i * 12)
+            self.entries[k] = (rb, ro)
+        self._refresh_fullness()
 
-    def randomize(self, n):
-        """Insert n random registers
+    def flush(self):
+        """Flush entries to disk.
         
         Arguments:
         - `self`:
-        - `n`: Number of random registers
         """
-        for x in xrange(1, n + 1):
-            k = random.randrange(1, 4000000)
-            self.insert(k, "Descricao {0}".format(k))
-    
-    def search_leaf(self, key):
-        """Search the leaf given a key insertion.
+        sl = [struct.pack("HH", self.depth, len(self.entries))]
+        for (k, (rb, ro)) in self.entries.iteritems():
+            sl.append(struct.pack("QHH", k, rb, ro))
+        self._datafile.write_block(self.blocknum, ''.join(sl))
+        self._datafile.sync()
+        self.entries = {}
+
+
+class DirectoryBlock(Block):
+    """The hash directory, bucket block numbers indexed by the low depth
+    bits of the hash.
+    """
+
+    def __init__(self, buf, blocknum):
+        """Needs a buffer/datafile relation for metadata
+        
+        Arguments:
+        - `buf`: A Buffer Object
+        - `blocknum`: Blocknumber
+        """
+        Block.__init__(self, buf, blocknum, DIRECTORY)
+        self.depth   = 0
+        self.buckets = []
+        self.load()
+
+    def load(self):
+        """Load the directory from disk.
         
         Arguments:
         - `self`:
-        - `key`: pk
         """
-        b = self.get_root()
+        if self.buckets:
+            raise ValueError("buckets must be empty")
+        data = self._datafile.read_block(self.blocknum)
+        (self.depth,) = struct.unpack_from("H", data, 0)
+        self.buckets = list(struct.unpack_from("{0}H".format(1 << self.depth),
+                                               data, 2))
 
-        while b.blocktype != LEAF:
-            pos = 0
-            for k in b.keys:
-                if key >= k:
-                    pos = pos + 1
-                else:
-                    break
-            b = self._buf.get_block(b.pointers[pos])
+    def flush(self):
+        """Flush the directory to disk.
+        
+        Arguments:
+        - `self`:
+        """
+        self._datafile.write_block(self.blocknum,
+            struct.pack("H{0}H".format(len(self.buckets)), self.depth,
+                        *self.buckets))
+        self._datafile.sync()
+        self.buckets = []
 
-        return b
 
-    def make_record(self, key, desc):
-        """Allocate a new record from any not full recordblock, returns a
-        Record object
+class BloomFilter(object):
+    """A Bloom filter of integer keys, answers "maybe there" or "surely not".
+    """
+
+    def __init__(self, nbits=BLOOMBITS, nhashes=BLOOMHASHES):
+        """Constructor, an empty filter.
         
         Arguments:
-        - `self`:
-        - `key`: Record key
-        - `desc`: Record description
+        - `nbits`: Size of the filter in bits, multiple of 8
+        - `nhashes`: Number of hash functions
         """
-        b = self._buf.get_notfull(RECORD)
-        return b.alloc(key, desc)
+        self.nbits   = nbits
+        self.nhashes = nhashes
+        self.bits    = bytearray(nbits / 8)
+        self.count   = 0
+        self.reset_stats()
 
-    def lookup_pprint(self, key):
-        """Lookup with pretty printing :-)
+    def reset_stats(self):
+        """Zero all counters.
         
         Arguments:
         - `self`:
-        - `key`: Record key to be looked up
         """
-        r = self.lookup(key)
-        if not r:
-            print("Record {0}".format(key))
-        else:
-            print("Record {0} => {1}".format(r.key, r.desc))
+        self.negatives       = 0
+        self.false_positives = 0
+
+    def _positions(self, key):
+        """Bit positions of key, double hashing of two 64 bit mixes.
         
-    def lookup(self, key):
-        """Lookup for a given record.
+        Arguments:
+        - `self`:
+        - `key`: Integer key
+        """
+        h1 = (key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h2 = ((key ^ (key >> 29)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        h1 = h1 ^ (h1 >> 31)
+        h2 = (h2 ^ (h2 >> 32)) | 1
+        return [(h1 + i * h2) % self.nbits for i in xrange(self.nhashes)]
+
+    def add(self, key):
+        """Add key to the filter.
         
         Arguments:
         - `self`:
-        - `key`: record key (pk)
+        - `key`: Integer key
         """
-        # Get the leaf
-        leaf = self.search_leaf(key)
-        if not leaf:
-            return None
-        # Get the record pointer
-        p = None
-        for i, k in enumerate(leaf.keys):
-            if k == key:
-                p = leaf.pointers[i]
-                break
-        if p is None:
-            return None
-        # Get the record block and return the record.
-        rb = self._buf.get_block(p[0])
-        return rb.records[p[1]]
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count = self.count + 1
 
-    def update(self, key, desc):
-        """Update a record of key to new desc
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def false_positive_rate(self):
+        """Measured false positive rate, false positives over all lookups
+        of absent keys.
         
         Arguments:
         - `self`:
-        - `key`: Key of record
-        - `desc`: New description of record
         """
-        rec      = self.lookup(key)
-        if not rec:
-            return None
-        rec.desc = desc
-        return rec
-    
-    def insert(self, key, desc):
-        """Insert a record into bplustree, handles all cases
+        absent = self.negatives + self.false_positives
+        if not absent:
+            return 0.0
+        return float(self.false_positives) / absent
+
+    def expected_false_positive_rate(self):
+        """Theoretical false positive rate for the current number of keys.
         
         Arguments:
         - `self`:
-        - `key`: Record key
-        - `desc`: Record desc
         """
-        if key < 1:
-            raise ValueError("Invalid key !!")
-        print("inserting {0}".format(key))
-        # Avoid double insert
-        if self.lookup(key):
-            return None
-        r           = self.make_record(key, desc)
-        rec_key     = r.key
-        rec_pointer = (r.blocknum, r.offset)
-        leafblock   = self.search_leaf(rec_key)
-        # Case 1: Yey ! leaf is not full
-        if not leafblock.full():
-            leafblock.insert(rec_key, rec_pointer)
-            return
+        return (1.0 - math.exp(-float(self.nhashes) * self.count /
+                               self.nbits)) ** self.nhashes
+
+    def stats(self):
+        """Return a dict of counters and false positive rates.
         
-        # Awww leaf is full :(
-        indexblock = leafblock.get_parent()
+        Arguments:
+        - `self`:
+        """
+        return {"keys": self.count, "bits": self.nbits,
+                "hashes": self.nhashes, "negatives": self.negatives,
+                "false_positives": self.false_positives,
+                "false_positive_rate": self.false_positive_rate(),
+                "expected_false_positive_rate":
+                    self.expected_false_positive_rate()}
 
-        # Case 2: Leaf is full, but parent isn't or root splitting
-        # Split the leaf, move top half to new leaf
-        newleafblock                     = self._buf.alloc(LEAF)
-        # Insert and split
-        leafmiddlekey, leafmiddlepointer = \
-            leafblock.insert_split(rec_key, rec_pointer, newleafblock)
-        # Leaf Root splitting
-        if leafblock.is_root():
-            # Alloc a new root
-            newroot                      = self._buf.alloc(BRANCH)
-            self.rootnum                 = newroot.blocknum
-            indexblock                   = newroot
-            leafblock.set_parent(indexblock)
-        # Finish case 2
-        if not indexblock.full():
-            leafblock.set_parent(indexblock)
-            newleafblock.set_parent(indexblock)
-            indexblock.new_insert(leafblock.blocknum, leafmiddlekey, 
-                                 newleafblock.blocknum)
-            return
-            
-        raise ValueError("Shouldn't reach here")
-    
-#         while indexblock and indexblock.full():
-#             # Alloc a new branchblock, will be the neighbour of our current
-#             # indexblock and will have the top-half keys of indexblock.
-#             newindexblock            = self._buf.alloc(BRANCH)
-#             # Insert the leaf key into indexblock (which is full) and force a
-#             # splitting, after the call, newindexblock should have the top-half
-#             # keys of indexblock, the middlekey is the first key of
-#             # newindexblock.
-#             middlekey, middlepointer = indexblock.new_insert_split(leafblock.blocknum,
-#                                                     leafmiddlekey,
-#                                                     newleafblock.blocknum,
-#                                                     newindexblock)
-            
-#             # Now we do not know if leafblock is in indexblock or
-#             # newindexblock, we don't care
-
-#             # We must now insert the middle key in the upperindex (parent),
-#             # with pointers to indexblock and newindexblock, if there is no
-#             # parent, we get a new root.
-#             upperindexblock     = indexblock.get_parent()
-#             # upperindexblock is the parent of our current index.
-#             if upperindexblock is None:
-#                 # Root splitting
-#                 # Alloc a new root
-#                 newroot         = self._buf.alloc(BRANCH)
-#                 self.rootnum    = newroot.blocknum
-#                 upperindexblock = newroot
-
-#             # Now link the fucking branches
-#             upperindexblock.new_insert(indexblock.blocknum, middlekey,
-#                                    middlepointer)
-#             indexblock.set_parent(upperindexblock)
-#             # Go up
-#             indexblock = indexblock.get_parent()
-#             print("upperindex = {0}".format(upperindexblock.blocknum))
-#             break
-#             # We should have the following
-# """
-#            _________________
-#           /                      \
-#           | upperindexblock |
-#           \_________________/
-#             /                    \
-#            /                     \
-#           /                      \
-#          /                       \
-#        _/_______________       \_________________             
-#       /                 \      / \
-#       |  indexblock     |      | newindexblock   |
-#       \_________________/      \_________________/
-
-# """
-#         # End of case 3
-
-def load_from_file(path):
-    """Load a BplusTree from file and return the object
-    
-    Arguments:
-    - `path`: file path
+
+class RecordCache(object):
+    """LRU cache of key -> Record above the buffer, hot keys are answered
+    without touching the tree.
     """
-    f = open(path, "r+b")
-    bp = pickle.load(f)
-    f.close()
-    bp._buf._datafile.fh = open(bp._buf._datafile.path, "r+b", BLOCKSIZE)
 
+    def __init__(self, size):
+        """Constructor
+        
+        Arguments:
+        - `size`: Maximum number of cached records
+        """
+        self.size     = size
+        self._entries = collections.OrderedDict()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def reset_stats(self):
+        """Zero all counters.
+        
+        Arguments:
+        - `self`:
+        """
+        self.hits   = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached record of key, or None.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        """
+        rec = self._entries.pop(key, None)
+        if rec is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        self._entries[key] = rec
+        return rec
+
+    def put(self, key, rec):
+        """Cache rec, the least recently used record goes if we are full.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        - `rec`: The Record
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = rec
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Forget key.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        """
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything.
+        
+        Arguments:
+        - `self`:
+        """
+        self._entries.clear()
+
+    def stats(self):
+        """Return a dict with size, hits, misses and hit rate.
+        
+        Arguments:
+        - `self`:
+        """
+        accesses = self.hits + self.misses
+        return {"size": self.size, "entries": len(self._entries),
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": float(self.hits) / accesses if accesses else 0.0}
+
+
+class Trace(object):
+    """I/O accounting of a group of operations, use as a context manager:
+    with tree.trace() as t: tree.lookup(k), then look at t.report().
+    """
+
+    def __init__(self, buf):
+        """Constructor
+        
+        Arguments:
+        - `buf`: The Buffer to trace
+        """
+        self._buf    = buf
+        self.events  = []
+        self.elapsed = 0.0
+        self._start  = None
+
+    def __enter__(self):
+        self.events = []
+        self._buf.subscribe(self.events.append)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *_):
+        self.elapsed = time.time() - self._start
+        self._buf.unsubscribe(self.events.append)
+        return False
+
+    def __str__(self):
+        r = self.report()
+        return ("Trace: {0:.6f}s, {1} blocks touched, {2} hits, {3} misses, "
+                "{4} evictions, {5} flushes, {6} allocs, {7:.6f}s I/O".format(
+                r["elapsed"], r["blocks"], r["hits"], r["misses"],
+                r["evictions"], r["flushes"], r["allocs"], r["io_time"]))
+
+    def report(self):
+        """Return a dict with blocks touched (total and per block type),
+        hits, misses, evictions, flushes, allocs and time spent.
+        
+        Arguments:
+        - `self`:
+        """
+        touched = {}
+        r = {"hits": 0, "misses": 0, "evictions": 0, "flushes": 0,
+             "allocs": 0, "io_time": 0.0, "elapsed": self.elapsed}
+        for e in self.events:
+            if e.op == "get_block":
+                touched[e.blocknum] = e.blocktype
+                if e.hit:
+                    r["hits"] = r["hits"] + 1
+                else:
+                    r["misses"] = r["misses"] + 1
+                if e.victim is not None:
+                    r["evictions"] = r["evictions"] + 1
+            elif e.op == "load":
+                r["io_time"] = r["io_time"] + e.duration
+            elif e.op == "flush":
+                r["flushes"] = r["flushes"] + 1
+                r["io_time"] = r["io_time"] + e.duration
+            elif e.op == "alloc":
+                r["allocs"] = r["allocs"] + 1
+        r["blocks"] = len(touched)
+        for t in set(touched.values()) | set((LEAF, BRANCH, RECORD)):
+            r[BLOCKTYPENAMES[t]] = touched.values().count(t)
+        return r
+
+
+class RecordHeap(object):
+    """Record storage of an access method, records live in RecordBlocks
+    and the index holds (blocknum, offset) pointers to them, or in the
+    leaves themselves when clustered. Needs _buf and clustered.
+    """
+
+    def make_record(self, key, desc):
+        """Allocate a new record from any not full recordblock, returns a
+        Record object
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        - `desc`: Record description
+        """
+        # The room hints pick a block desc fits in without loading others,
+        # a block with no hint yet gets one when it is loaded
+        need = RecordBlock.payload(desc)
+        b    = self._buf.get_notfull(RECORD, need)
+        while not b.fits(desc):
+            b = self._buf.get_notfull(RECORD, need)
+        return b.alloc(key, desc)
+
+    def _fetch_records(self, entries):
+        """Prefetch the record blocks of entries and return their records.
+        
+        Arguments:
+        - `self`:
+        - `entries`: List of (key, pointer)
+        """
+        if self.clustered:
+            return [p for _, p in entries]
+        self._buf.prefetch(set(p[0] for _, p in entries))
+        return [self._buf.get_block(p[0]).records[p[1]] for _, p in entries]
+
+    def _record(self, pointer):
+        """Return the record a leaf pointer refers to.
+        
+        Arguments:
+        - `self`:
+        - `pointer`: (blocknum, offset), or a Record on a clustered tree
+        """
+        if self.clustered:
+            return pointer
+        return self._buf.get_block(pointer[0]).records[pointer[1]]
+
+    def _check_clustered(self, desc):
+        """Refuse a desc a DataLeafBlock record would not keep whole.
+        
+        Arguments:
+        - `self`:
+        - `desc`: Record desc
+        """
+        if len(desc) > DATALEAFDESC:
+            raise ValueError("clustered desc longer than {0} bytes".format(
+                    DATALEAFDESC))
+        if "\x00" in desc:
+            raise ValueError("clustered desc with a NUL byte")
+
+    def _new_record(self, key, desc):
+        """Make a new record, returns (record, leaf pointer).
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        - `desc`: Record desc
+        """
+        if self.clustered:
+            self._check_clustered(desc)
+            r = Record(-1, -1)
+            r.key  = key
+            r.desc = desc
+            return r, r
+        r = self.make_record(key, desc)
+        return r, (r.blocknum, r.offset)
+
+    def _set_desc(self, pointer, desc):
+        """Change the desc of the record a leaf pointer refers to, returns
+        the pointer to the record, which moves to another block if the
+        new desc does not fit in its own.
+        
+        Arguments:
+        - `self`:
+        - `pointer`: (blocknum, offset), or a Record on a clustered tree
+        - `desc`: New record desc
+        """
+        if self.clustered:
+            self._check_clustered(desc)
+            pointer.desc = desc
+            return pointer
+        b = self._buf.get_block(pointer[0])
+        if b.resize(pointer[1], desc):
+            return pointer
+        r = self.make_record(b.records[pointer[1]].key, desc)
+        self._free_record(pointer)
+        return (r.blocknum, r.offset)
+
+    def _free_record(self, pointer):
+        """Free the record a removed leaf pointer referred to.
+        
+        Arguments:
+        - `self`:
+        - `pointer`: (blocknum, offset), or a Record on a clustered tree
+        """
+        if not self.clustered:
+            self._buf.get_block(pointer[0]).free(pointer[1])
+
+
+class AccessMethod(RecordHeap):
+    """What BplusTree and HashIndex share besides the records: persistence,
+    latency counters and tracing. Needs _buf and _cache.
+    """
+
+    def close(self):
+        """Save all state to disk
+        
+        Arguments:
+        - `self`:
+        """
+        self._buf.save_warm()
+        self._buf.flush_all()
+        if self.readonly:
+            self._buf._datafile.close()
+            return
+        f = open(self._buf._datafile.path + ".pickle", "w")
+        self._buf._datafile.close()
+        pickle.dump(self, f)
+        f.close()
+
+    def reset_stats(self):
+        """Zero the latencies, the record cache, buffer and datafile
+        counters.
+        
+        Arguments:
+        - `self`:
+        """
+        self.lookup_time = Histogram()
+        self.insert_time = Histogram()
+        self._buf.reset_stats()
+        if self._cache is not None:
+            self._cache.reset_stats()
+
+    def trace(self):
+        """Return a Trace context manager which accounts all block accesses
+        done inside the with block.
+        
+        Arguments:
+        - `self`:
+        """
+        return Trace(self._buf)
+
+    def __getstate__(self):
+        """Pickle support, the record cache starts empty.
+        
+        Arguments:
+        - `self`:
+        """
+        state = self.__dict__.copy()
+        if self._cache is not None:
+            state["_cache"] = RecordCache(self._cache.size)
+        return state
+
+    @property
+    def readonly(self):
+        """True if the datafile was opened read-only.
+        
+        Arguments:
+        - `self`:
+        """
+        return self._buf._datafile.readonly
+
+
+class BplusTree(AccessMethod):
+    """A B+ Tree object, this where the shit happens.
+    """
+
+    def __init__(self, path, pin_levels=PINLEVELS, pin_budget=MAXPINNED,
+                 bloom=False, cache_size=0, clustered=False,
+                 desc_index=False, compress=False, split_fill=SPLITFILL):
+        """Create a new BplusTree, needs a buf to fetch/store blocks
+        
+        Arguments:
+        - `path`: Buffer storage path
+        - `pin_levels`: Number of tree levels, from the root down, which are
+        pinned in the buffer
+        - `pin_budget`: Maximum number of pinned blocks
+        - `bloom`: Keep a Bloom filter of all keys, lookups of absent keys
+        (and the duplicate check of insert) then mostly skip the tree walk
+        - `cache_size`: Number of records kept in a RecordCache, 0 for none
+        - `clustered`: Keep records in the leaves (DataLeafBlock) instead of
+        in RecordBlocks pointed to by the leaves
+        - `desc_index`: Keep a DescIndex, for lookup_by_desc and
+        scan_desc_prefix
+        - `compress`: Keep blocks zlib compressed on disk, fewer bytes read
+        for more CPU
+        - `split_fill`: Fill of the left block when a split is caused by an
+        append at the right edge, 1.0 leaves full blocks behind sequential
+        inserts
+        """
+        if clustered and desc_index:
+            raise ValueError("desc_index needs the records in RecordBlocks")
+        self._setup(Buffer(path, pin_budget, compress=compress), path,
+                    pin_levels, split_fill, clustered)
+        self._bloom     = BloomFilter() if bloom else None
+        self._cache     = RecordCache(cache_size) if cache_size else None
+        self.reset_stats()
+        self._descindex = DescIndex(self) if desc_index else None
+        self._refresh_pins()
+
+    def _setup(self, buf, path, pin_levels, split_fill, clustered):
+        """Set the state every tree has, with no Bloom filter, record cache
+        nor desc index, and allocate an empty root leaf in buf.
+        
+        Arguments:
+        - `self`:
+        - `buf`: Buffer of the tree
+        - `path`: Buffer storage path
+        - `pin_levels`: Number of tree levels pinned in the buffer
+        - `split_fill`: Fill of the left block of a right edge split
+        - `clustered`: Keep records in the leaves
+        """
+        self._buf       = buf
+        self.path       = path
+        self.pin_levels = pin_levels
+        self.split_fill = split_fill
+        self._bloom     = None
+        self._cache     = None
+        self.clustered  = clustered
+        self._leaftype  = DATALEAF if clustered else LEAF
+        self._descindex = None
+        # Compactor copying this tree, it gets told of every change
+        self._compactor = None
+        # Bumped on every split, cursors with an older version re-descend
+        self._version   = 0
+        self._cursor    = Cursor(self)
+        self.lookup_time = Histogram()
+        self.insert_time = Histogram()
+        self.descents    = 0
+        # Make sure root is there.
+        root            = self._buf.alloc(self._leaftype)
+        self.rootnum    = root.blocknum
+
+    def reset_stats(self):
+        """Zero all counters, buffer and datafile included, call it to start
+        a new measurement window.
+        
+        Arguments:
+        - `self`:
+        """
+        AccessMethod.reset_stats(self)
+        self.descents = 0
+        if self._bloom is not None:
+            self._bloom.reset_stats()
+
+    def stats(self):
+        """Return a dict with lookup and insert latencies and the buffer
+        (and datafile) counters.
+        
+        Arguments:
+        - `self`:
+        """
+        stats = {"lookup": self.lookup_time.stats(),
+                 "insert": self.insert_time.stats(),
+                 "descents": self.descents,
+                 "buffer": self._buf.stats()}
+        if self._bloom is not None:
+            stats["bloom"] = self._bloom.stats()
+        if self._cache is not None:
+            stats["cache"] = self._cache.stats()
+        return stats
+
+    def __getstate__(self):
+        """Pickle support, the Bloom filter is rebuilt on load instead.
+        
+        Arguments:
+        - `self`:
+        """
+        state = AccessMethod.__getstate__(self)
+        state["_bloom"]     = self._bloom is not None
+        state["_compactor"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bloom = BloomFilter() if state.get("_bloom") else None
+
+    def rebuild_bloom(self):
+        """Fill the Bloom filter from the leaves, record blocks are not read.
+        
+        Arguments:
+        - `self`:
+        """
+        if self._bloom is None:
+            return
+        self._bloom = BloomFilter(self._bloom.nbits, self._bloom.nhashes)
+        for key, _ in self.scan_entries():
+            self._bloom.add(key)
+
+    def _refresh_pins(self):
+        """Pin the branch blocks of the top pin_levels levels of the tree,
+        breadth first until the pin budget runs out, and unpin whatever is no
+        longer up there. Must be called whenever the upper levels change shape.
+        
+        Arguments:
+        - `self`:
+        """
+        wanted = []
+        level  = [self.rootnum]
+        for _ in xrange(self.pin_levels):
+            nextlevel = []
+            for bnum in level:
+                (btype, _, _) = self._buf._datafile.get_meta(bnum)
+                # Only inner nodes, leaves compete for frames as usual
+                if btype != BRANCH or len(wanted) == self._buf.maxpinned:
+                    continue
+                wanted.append(bnum)
+                nextlevel.extend(self._buf.get_block(bnum).pointers)
+            level = nextlevel
+        for bnum in self._buf.pinned():
+            if bnum not in wanted:
+                self._buf.unpin(bnum)
+        for bnum in wanted:
+            self._buf.pin(bnum)
+    
+    def get_root(self):
+        """Fetch root block
+        
+        Arguments:
+        - `self`:
+        """
+        return self._buf.get_block(self.rootnum)
+
+    def randomize(self, n):
+        """Insert n random registers
+        
+        Arguments:
+        - `self`:
+        - `n`: Number of random registers
+        """
+        for x in xrange(1, n + 1):
+            k = random.randrange(1, 4000000)
+            self.insert(k, "Descricao {0}".format(k))
+    
+    def search_leaf(self, key):
+        """Search the leaf given a key insertion.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        """
+        return self._descend(key)[1]
+
+    def _descend(self, key):
+        """Walk from the root down to the leaf which should hold key, returns
+        (path, leaf, low, high), path is a list of (branch blocknum, child
+        position) from the root down, the leaf may only hold keys in
+        [low, high), None meaning unbounded.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        """
+        path = []
+        low  = None
+        high = None
+        b    = self.get_root()
+        while b.blocktype == BRANCH:
+            pos = bisect.bisect_right(b.keys, key)
+            if pos > 0:
+                low = b.keys[pos - 1]
+            if pos < len(b.keys):
+                high = b.keys[pos]
+            path.append((b.blocknum, pos))
+            b = self._buf.get_block(b.pointers[pos])
+        self.descents = self.descents + 1
+        return path, b, low, high
+
+    def _count(self, path, delta):
+        """Add delta to the key counts along path, after a leaf entry was
+        added or removed.
+        
+        Arguments:
+        - `self`:
+        - `path`: List of (branch blocknum, child position)
+        - `delta`: 1 or -1
+        """
+        for (bnum, pos) in path:
+            b = self._buf.get_block(bnum)
+            b.counts[pos] = b.counts[pos] + delta
+
+    def rank(self, key):
+        """Number of keys lower than key, reads one block per level. Goes
+        down left of branch keys equal to key, with repeated keys (as in a
+        DescIndex) the children on the left may hold key too.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk, need not be in the tree
+        """
+        r = 0
+        b = self.get_root()
+        while b.blocktype == BRANCH:
+            pos = bisect.bisect_left(b.keys, key)
+            r = r + sum(b.counts[:pos])
+            b = self._buf.get_block(b.pointers[pos])
+        self.descents = self.descents + 1
+        return r + bisect.bisect_left(b.keys, key)
+
+    def count(self, lo=None, hi=None):
+        """Number of keys with lo <= key <= hi, None meaning unbounded.
+        
+        Arguments:
+        - `self`:
+        - `lo`: Lowest key
+        - `hi`: Highest key
+        """
+        if lo is not None and hi is not None and hi < lo:
+            return 0
+        if hi is None:
+            b    = self.get_root()
+            high = sum(b.counts) if b.blocktype == BRANCH else len(b.keys)
+        else:
+            high = self.rank(hi + 1)
+        low = 0 if lo is None else self.rank(lo)
+        return high - low
+
+    def select(self, k):
+        """Return the record with the k-th lowest key (from 0), or None if
+        there are not that many. To page, seek a cursor() to its key and
+        step with next().
+        
+        Arguments:
+        - `self`:
+        - `k`: Rank, negative counts from the end
+        """
+        if k < 0:
+            k = k + self.count()
+        if k < 0:
+            return None
+        b = self.get_root()
+        while b.blocktype == BRANCH:
+            for pos, c in enumerate(b.counts):
+                if k < c:
+                    break
+                k = k - c
+            else:
+                return None
+            b = self._buf.get_block(b.pointers[pos])
+        self.descents = self.descents + 1
+        if k >= len(b.keys):
+            return None
+        # The cursor seeks to the first of repeated keys, take the pointer
+        # of the k-th entry itself
+        self._cursor.seek(b.keys[k])
+        return self._record(b.pointers[k])
+
+    def cursor(self):
+        """Return a new Cursor on this tree.
+        
+        Arguments:
+        - `self`:
+        """
+        return Cursor(self)
+
+    def compactor(self, path=None, fill=SPLITFILL):
+        """Return a Compactor which copies this tree into a fresh datafile,
+        see compact().
+        
+        Arguments:
+        - `self`:
+        - `path`: Path of the new datafile, default path + ".compact"
+        - `fill`: Fill of the copied leaves and branches
+        """
+        if self.readonly:
+            raise ValueError("compaction of a readonly tree")
+        if self._compactor is not None:
+            raise ValueError("tree is already being compacted")
+        if path is None:
+            path = self._buf._datafile.path + ".compact"
+        self._compactor = Compactor(self, path, fill)
+        return self._compactor
+
+    def compact(self, path=None, fill=SPLITFILL, batch=COMPACTBATCH):
+        """Rebuild the tree into a new datafile with full leaves laid out in
+        key order and records in key order, then swap the tree over to it.
+        This does all the work at once, to keep serving meanwhile get a
+        compactor() and call its step() between other operations.
+        
+        Arguments:
+        - `self`:
+        - `path`: Path of the new datafile, default path + ".compact"
+        - `fill`: Fill of the copied leaves and branches
+        - `batch`: Entries copied per step
+        """
+        c = self.compactor(path, fill)
+        while c.step(batch):
+            pass
+        c.finish()
+
+    def _bulk_load(self, entries):
+        """Build the leaf and branch levels from scratch, leaves are filled
+        up one after the other and branches on top of them. The tree must
+        have no leaves or branches left, rootnum is set to the new root.
+        
+        Arguments:
+        - `self`:
+        - `entries`: Iterable of (key, pointer) in key order
+        """
+        buf   = self._buf
+        # (first key, blocknum, keys under it) of each block of a level
+        level = []
+        leaf  = None
+        for key, pointer in entries:
+            if leaf is None or leaf.full():
+                leaf = buf.alloc(self._leaftype,
+                                 leaf.blocknum if leaf is not None else None)
+                level.append([key, leaf.blocknum, 0])
+            leaf.size = leaf.size + \
+                insert_cost(leaf.keys, len(leaf.keys), key) + LEAFPOINTER
+            leaf.keys.append(key)
+            leaf.pointers.append(pointer)
+            leaf._refresh_fullness()
+            level[-1][2] = level[-1][2] + 1
+        if leaf is None:
+            self.rootnum = buf.alloc(self._leaftype).blocknum
+            return
+        while len(level) > 1:
+            # Group the children as they fit, keys are the first keys of
+            # all children but the first
+            groups = [[]]
+            size   = BRANCHHEADER
+            keys   = []
+            for child in level:
+                if size > BLOCKSIZE - MAXVARINT - BRANCHCHILD:
+                    groups.append([])
+                    size = BRANCHHEADER
+                    keys = []
+                if groups[-1]:
+                    size = size + insert_cost(keys, len(keys), child[0])
+                    keys.append(child[0])
+                size = size + BRANCHCHILD
+                groups[-1].append(child)
+            # A branch needs two children
+            if len(groups[-1]) == 1:
+                groups[-1].insert(0, groups[-2].pop())
+            nextlevel = []
+            bnum      = None
+            for group in groups:
+                b = buf.alloc(BRANCH, bnum)
+                bnum       = b.blocknum
+                b.keys     = [c[0] for c in group[1:]]
+                b.pointers = [c[1] for c in group]
+                b.counts   = [c[2] for c in group]
+                b._resize()
+                for c in group:
+                    buf._datafile.set_parent(c[1], bnum)
+                nextlevel.append([group[0][0], bnum, sum(b.counts)])
+            level = nextlevel
+        self.rootnum = level[0][1]
+
+    def lookup_pprint(self, key):
+        """Lookup with pretty printing :-)
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key to be looked up
+        """
+        r = self.lookup(key)
+        if not r:
+            print("Record {0}".format(key))
+        else:
+            print("Record {0} => {1}".format(r.key, r.desc))
+        
+    def lookup(self, key):
+        """Lookup for a given record.
+        
+        Arguments:
+        - `self`:
+        - `key`: record key (pk)
+        """
+        start = time.time()
+        rec = self._lookup(key)
+        self.lookup_time.add(time.time() - start)
+        return rec
+
+    def _lookup(self, key):
+        """Lookup for a given record, not accounted in stats.
+        
+        Arguments:
+        - `self`:
+        - `key`: record key (pk)
+        """
+        cache = self._cache
+        if cache is not None:
+            rec = cache.get(key)
+            if rec is not None:
+                return rec
+        bloom = self._bloom
+        if bloom is not None and key not in bloom:
+            bloom.negatives = bloom.negatives + 1
+            return None
+        # Our own cursor, lookups of nearby keys skip the descent
+        if not self._cursor.seek(key):
+            if bloom is not None:
+                bloom.false_positives = bloom.false_positives + 1
+            return None
+        rec = self._cursor.record()
+        if cache is not None:
+            cache.put(key, rec)
+        return rec
+
+    def multi_get(self, keys):
+        """Lookup many records at once, returns a list of records (or None)
+        in the same order as keys.
+        
+        Arguments:
+        - `self`:
+        - `keys`: Iterable of record keys
+        """
+        keys     = list(keys)
+        pointers = {}
+        # Walk the keys in order so neighbour keys hit the same leaf
+        cursor   = self.cursor()
+        for key in sorted(set(keys)):
+            if self._bloom is not None and key not in self._bloom:
+                continue
+            if cursor.seek(key):
+                pointers[key] = cursor.pointer()
+        # Now we know every record block we need, read them in batches
+        entries = sorted(pointers.iteritems(), key=lambda x: x[1])
+        found   = dict(zip([k for k, _ in entries],
+                           self._fetch_records(entries)))
+        return [found.get(key) for key in keys]
+
+    def scan(self, lo=None, hi=None):
+        """Generator, yields all records with lo <= key <= hi in key order,
+        None means unbounded.
+        
+        Arguments:
+        - `self`:
+        - `lo`: Lowest key
+        - `hi`: Highest key
+        """
+        entries = []
+        for entry in self.scan_entries(lo, hi):
+            entries.append(entry)
+            # Read ahead the record blocks of the next few entries
+            if len(entries) < MAXREADAHEAD:
+                continue
+            for rec in self._fetch_records(entries):
+                yield rec
+            entries = []
+        for rec in self._fetch_records(entries):
+            yield rec
+
+    def scan_entries(self, lo=None, hi=None):
+        """Generator, yields the (key, pointer) leaf entries with
+        lo <= key <= hi in key order, only leaves and branches are read.
+        
+        Arguments:
+        - `self`:
+        - `lo`: Lowest key
+        - `hi`: Highest key
+        """
+        for _, b in self._scan_leaves(lo, hi):
+            for entry in [(k, p) for k, p in zip(b.keys, b.pointers)
+                          if (lo is None or k >= lo) and
+                          (hi is None or k <= hi)]:
+                yield entry
+
+    def _scan_leaves(self, lo=None, hi=None):
+        """Generator, yields (path, leaf) for the leaves which may hold keys
+        in [lo, hi] in key order, path as in _descend.
+        
+        Arguments:
+        - `self`:
+        - `lo`: Lowest key
+        - `hi`: Highest key
+        """
+        # Stack of blocknums still to be visited, rightmost at the bottom
+        stack = [self.rootnum]
+        paths = [()]
+        while stack:
+            # Whatever comes next on the stack is read ahead
+            self._buf.prefetch(stack[-PREFETCHBLOCKS:])
+            b    = self._buf.get_block(stack.pop())
+            path = paths.pop()
+            if b.blocktype == BRANCH:
+                # Copy, b may be victimized while we descend
+                keys     = list(b.keys)
+                pointers = list(b.pointers)
+                for i in xrange(len(pointers) - 1, -1, -1):
+                    # Child i holds keys in [keys[i-1], keys[i]], a key
+                    # equal to keys[i] only if the tree has duplicates
+                    if lo is not None and i < len(keys) and keys[i] < lo:
+                        continue
+                    if hi is not None and i > 0 and keys[i - 1] > hi:
+                        continue
+                    stack.append(pointers[i])
+                    paths.append(path + ((b.blocknum, i),))
+                continue
+            yield list(path), b
+
+    def lookup_by_desc(self, desc):
+        """Return the list of records with desc, needs a desc_index.
+        
+        Arguments:
+        - `self`:
+        - `desc`: Record description
+        """
+        if self._descindex is None:
+            raise ValueError("tree has no desc_index")
+        return self._descindex.lookup(desc)
+
+    def scan_desc_prefix(self, prefix):
+        """Generator, yields the records whose desc starts with prefix,
+        needs a desc_index.
+        
+        Arguments:
+        - `self`:
+        - `prefix`: Description prefix
+        """
+        if self._descindex is None:
+            raise ValueError("tree has no desc_index")
+        return self._descindex.scan_prefix(prefix)
+
+    def update(self, key, desc):
+        """Update a record of key to new desc
+        
+        Arguments:
+        - `self`:
+        - `key`: Key of record
+        - `desc`: New description of record
+        """
+        if self.readonly:
+            raise ValueError("update on a readonly tree")
+        if not self._cursor.seek(key):
+            return None
+        return self._cursor.update(desc)
+
+    def delete(self, key):
+        """Delete the record of key, returns True if it was there. Leaves
+        are not merged, an emptied leaf stays in the tree.
+        
+        Arguments:
+        - `self`:
+        - `key`: Key of record
+        """
+        if self.readonly:
+            raise ValueError("delete on a readonly tree")
+        return self._cursor.delete(key)
+    
+    def insert(self, key, desc):
+        """Insert a record into bplustree, handles all cases
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        - `desc`: Record desc
+        """
+        start = time.time()
+        ret = self._insert(key, desc)
+        self.insert_time.add(time.time() - start)
+        return ret
+
+    def insert_many(self, items):
+        """Insert many records at once, they are sorted first so the
+        cursor finds most leaves without a descent. Returns the number of
+        records inserted, keys already there are skipped.
+        
+        Arguments:
+        - `self`:
+        - `items`: Iterable of (key, desc)
+        """
+        n = 0
+        for key, desc in sorted(items, key=lambda x: x[0]):
+            if self._insert(key, desc) is not None:
+                n = n + 1
+        return n
+
+    def _insert(self, key, desc):
+        """Insert a record, not accounted in stats.
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        - `desc`: Record desc
+        """
+        if self.readonly:
+            raise ValueError("insert on a readonly tree")
+        return self._cursor.insert(key, desc)
+
+    def _insert_entry(self, cursor, key, pointer):
+        """Insert key and pointer in the leaf cursor is on, splits go up
+        along the cursor path, which is then no longer valid.
+        
+        Arguments:
+        - `self`:
+        - `cursor`: A Cursor on the leaf which should hold key
+        - `key`: Record key
+        - `pointer`: Record pointer, (blocknum, offset)
+        """
+        self._count(cursor.path, 1)
+        leafblock = cursor._leaf()
+        # Case 1: Yey ! leaf is not full
+        if not leafblock.full():
+            leafblock.insert(key, pointer)
+            return
+        
+        # Awww leaf is full :(
+        # Split the leaf, move top half to new leaf
+        newleafblock = self._buf.alloc(self._leaftype, cursor.leafnum)
+        leafblock    = cursor._leaf()
+        # Appends to the rightmost leaf leave it (and the branches above,
+        # all on their rightmost pointer) split_fill full, not half empty
+        fill         = 0.5
+        if cursor.high is None and key > leafblock.keys[-1]:
+            fill     = self.split_fill
+        middlekey, _ = leafblock.insert_split(key, pointer, newleafblock, fill)
+        left         = leafblock.blocknum
+        right        = newleafblock.blocknum
+        leftcount    = len(leafblock.keys)
+        rightcount   = len(newleafblock.keys)
+        path         = list(cursor.path)
+        # Every cursor on this tree has to look at the branches again
+        self._version = self._version + 1
+        splits        = False
+        # Go up inserting the middle key, splitting full branches
+        while path:
+            bnum, pos  = path.pop()
+            indexblock = self._buf.get_block(bnum)
+            self._buf._datafile.set_parent(right, bnum)
+            if not indexblock.full():
+                indexblock.new_insert(pos, left, middlekey, right, leftcount,
+                                      rightcount)
+                if splits:
+                    self._refresh_pins()
+                return
+            newindexblock = self._buf.alloc(BRANCH, bnum)
+            indexblock    = self._buf.get_block(bnum)
+            middlekey, _  = indexblock.new_insert_split(pos, left, middlekey,
+                                                        right, leftcount,
+                                                        rightcount,
+                                                        newindexblock, fill)
+            left          = bnum
+            right         = newindexblock.blocknum
+            leftcount     = sum(indexblock.counts)
+            rightcount    = sum(newindexblock.counts)
+            splits        = True
+        # Root splitting, alloc a new root
+        newroot      = self._buf.alloc(BRANCH)
+        newroot.new_insert(0, left, middlekey, right, leftcount, rightcount)
+        self._buf._datafile.set_parent(left, newroot.blocknum)
+        self._buf._datafile.set_parent(right, newroot.blocknum)
+        self.rootnum = newroot.blocknum
+        self._refresh_pins()
+
+
+class Cursor(object):
+    """A position in a BplusTree. The cursor remembers the root-to-leaf path
+    of its leaf and the key range the leaf covers, so operations on keys in
+    that range do not walk down from the root again.
+    """
+
+    def __init__(self, tree):
+        """Constructor, the cursor starts unpositioned.
+        
+        Arguments:
+        - `tree`: A BplusTree
+        """
+        self.tree    = tree
+        self.path    = []
+        self.leafnum = None
+        self.low     = None
+        self.high    = None
+        self.version = None
+        # Key of the current entry, None if not on an entry
+        self.curkey  = None
+
+    def invalidate(self):
+        """Forget the path, the next operation walks down from the root.
+        
+        Arguments:
+        - `self`:
+        """
+        self.leafnum = None
+
+    def _leaf(self):
+        """Get the current leaf block.
+        
+        Arguments:
+        - `self`:
+        """
+        return self.tree._buf.get_block(self.leafnum)
+
+    def _valid(self):
+        """True if the remembered path is still good.
+        
+        Arguments:
+        - `self`:
+        """
+        return self.leafnum is not None and self.version == self.tree._version
+
+    def _covers(self, key):
+        """True if key belongs to the current leaf.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        """
+        return self._valid() and (self.low is None or key >= self.low) and \
+            (self.high is None or key < self.high)
+
+    def _locate(self, key):
+        """Move to the leaf which should hold key, walking down from the
+        root only if key is out of the current leaf range. Returns the leaf.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        """
+        if self._covers(key):
+            return self._leaf()
+        self.path, leaf, self.low, self.high = self.tree._descend(key)
+        self.leafnum = leaf.blocknum
+        self.version = self.tree._version
+        return leaf
+
+    def _set_path(self, path, leaf):
+        """Make path and leaf current, recomputing the leaf key range.
+        
+        Arguments:
+        - `self`:
+        - `path`: List of (branch blocknum, child position)
+        - `leaf`: Leaf block
+        """
+        self.low  = None
+        self.high = None
+        for bnum, pos in path:
+            keys = self.tree._buf.get_block(bnum).keys
+            if pos > 0:
+                self.low = keys[pos - 1]
+            if pos < len(keys):
+                self.high = keys[pos]
+        self.path    = path
+        self.leafnum = leaf.blocknum
+        self.version = self.tree._version
+
+    def _step_leaf(self, direction):
+        """Move to the next (direction 1) or previous (direction -1) leaf
+        going up the path only as much as needed. Returns the leaf or None,
+        in which case the cursor did not move.
+        
+        Arguments:
+        - `self`:
+        - `direction`: 1 or -1
+        """
+        buf  = self.tree._buf
+        path = list(self.path)
+        while path:
+            bnum, pos = path.pop()
+            b = buf.get_block(bnum)
+            pos = pos + direction
+            if pos < 0 or pos >= len(b.pointers):
+                continue
+            path.append((bnum, pos))
+            child = buf.get_block(b.pointers[pos])
+            while child.blocktype == BRANCH:
+                pos = 0 if direction > 0 else len(child.pointers) - 1
+                path.append((child.blocknum, pos))
+                child = buf.get_block(child.pointers[pos])
+            self._set_path(path, child)
+            return child
+        return None
+
+    def seek(self, key):
+        """Position on the first entry with a key >= key, returns True if
+        it is key itself.
+        
+        Arguments:
+        - `self`:
+        - `key`: pk
+        """
+        leaf = self._locate(key)
+        i = bisect.bisect_left(leaf.keys, key)
+        while i == len(leaf.keys):
+            leaf = self._step_leaf(1)
+            if leaf is None:
+                self.curkey = None
+                return False
+            i = 0
+        self.curkey = leaf.keys[i]
+        return self.curkey == key
+
+    def _current(self):
+        """Return (leaf, index) of the current entry, or (None, None).
+        
+        Arguments:
+        - `self`:
+        """
+        if self.curkey is None:
+            return None, None
+        leaf = self._locate(self.curkey)
+        i = bisect.bisect_left(leaf.keys, self.curkey)
+        if i == len(leaf.keys) or leaf.keys[i] != self.curkey:
+            return None, None
+        return leaf, i
+
+    def key(self):
+        """Key of the current entry, or None.
+        
+        Arguments:
+        - `self`:
+        """
+        return self.curkey
+
+    def pointer(self):
+        """Record pointer of the current entry, or None.
+        
+        Arguments:
+        - `self`:
+        """
+        leaf, i = self._current()
+        if leaf is None:
+            return None
+        return leaf.pointers[i]
+
+    def record(self):
+        """Record of the current entry, or None.
+        
+        Arguments:
+        - `self`:
+        """
+        p = self.pointer()
+        if p is None:
+            return None
+        return self.tree._record(p)
+
+    def next(self):
+        """Move to the next entry, returns False if there is none, the
+        cursor then stays where it is.
+        
+        Arguments:
+        - `self`:
+        """
+        if self.curkey is None:
+            return False
+        leaf = self._locate(self.curkey)
+        i = bisect.bisect_right(leaf.keys, self.curkey)
+        while i == len(leaf.keys):
+            leaf = self._step_leaf(1)
+            if leaf is None:
+                return False
+            i = 0
+        self.curkey = leaf.keys[i]
+        return True
+
+    def prev(self):
+        """Move to the previous entry, returns False if there is none, the
+        cursor then stays where it is.
+        
+        Arguments:
+        - `self`:
+        """
+        if self.curkey is None:
+            return False
+        leaf = self._locate(self.curkey)
+        i = bisect.bisect_left(leaf.keys, self.curkey) - 1
+        while i < 0:
+            leaf = self._step_leaf(-1)
+            if leaf is None:
+                return False
+            i = len(leaf.keys) - 1
+        self.curkey = leaf.keys[i]
+        return True
+
+    def insert(self, key, desc):
+        """Insert a record and position on it, returns the record or None if
+        key is already there.
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        - `desc`: Record desc
+        """
+        tree = self.tree
+        if tree.readonly:
+            raise ValueError("insert on a readonly tree")
+        if key < 1:
+            raise ValueError("Invalid key !!")
+        # Avoid double insert
+        leaf = self._locate(key)
+        i = bisect.bisect_left(leaf.keys, key)
+        if i < len(leaf.keys) and leaf.keys[i] == key:
+            return None
+        # Index the desc first, the leaf must not get an entry the desc
+        # index never saw
+        dkey = None
+        if tree._descindex is not None:
+            dkey = tree._descindex.key(desc)
+        r, pointer = tree._new_record(key, desc)
+        if dkey is not None:
+            tree._descindex.add(dkey, pointer)
+        if tree._bloom is not None:
+            tree._bloom.add(key)
+        tree._insert_entry(self, key, pointer)
+        if tree._compactor is not None:
+            tree._compactor.changed.add(key)
+        self.curkey = key
+        return r
+
+    def update(self, desc):
+        """Update the record of the current entry, returns it or None.
+        
+        Arguments:
+        - `self`:
+        - `desc`: New description of record
+        """
+        if self.tree.readonly:
+            raise ValueError("update on a readonly tree")
+        tree = self.tree
+        p = self.pointer()
+        if p is None:
+            return None
+        # A cached copy may be from a block which has left the buffer
+        if tree._cache is not None:
+            tree._cache.invalidate(self.curkey)
+        dindex = tree._descindex
+        if dindex is not None:
+            dkey = dindex.key(desc)
+            dindex.remove(dindex.key(tree._record(p).desc), p)
+        newp = tree._set_desc(p, desc)
+        if newp != p:
+            # The record moved, the leaf may have left the buffer meanwhile
+            leaf, i = self._current()
+            leaf.pointers[i] = newp
+        if dindex is not None:
+            dindex.add(dkey, newp)
+        if tree._compactor is not None:
+            tree._compactor.changed.add(self.curkey)
+        return tree._record(newp)
+
+    def delete(self, key):
+        """Delete the record of key, returns True if it was there. The
+        cursor is left on the entry after key, if any.
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        """
+        tree = self.tree
+        if tree.readonly:
+            raise ValueError("delete on a readonly tree")
+        if tree._cache is not None:
+            tree._cache.invalidate(key)
+        leaf = self._locate(key)
+        p = leaf.remove(key)
+        if p is None:
+            return False
+        tree._count(self.path, -1)
+        if tree._descindex is not None:
+            dkey = tree._descindex.key(tree._record(p).desc)
+            tree._descindex.remove(dkey, p)
+        tree._free_record(p)
+        if tree._compactor is not None:
+            tree._compactor.changed.add(key)
+        self.seek(key)
+        return True
+
+class Compactor(object):
+    """Online compaction of a BplusTree. step() copies the next entries in
+    key order into a new tree, appends at its right edge leave full blocks
+    behind. The tree logs every key changed meanwhile, finish() replays
+    those into the copy and swaps the tree over to the new datafile.
+    """
+
+    def __init__(self, tree, path, fill=SPLITFILL):
+        """Constructor, creates the new datafile, use tree.compactor().
+        
+        Arguments:
+        - `tree`: The BplusTree to compact
+        - `path`: Path of the new datafile
+        - `fill`: Split fill of the new tree while copying
+        """
+        cache         = tree._cache
+        self.tree     = tree
+        self.new      = BplusTree(path, tree.pin_levels, tree._buf.maxpinned,
+                                  tree._bloom is not None,
+                                  cache.size if cache is not None else 0,
+                                  tree.clustered, tree._descindex is not None,
+                                  tree._buf._datafile.compress, fill)
+        # Highest key copied so far, None before the first step
+        self.last     = None
+        self.done     = False
+        # Keys changed in tree since the copy started
+        self.changed  = set()
+        self.copied   = 0
+        self.replayed = 0
+
+    def step(self, n=COMPACTBATCH):
+        """Copy the next n entries, returns False once all are copied.
+        
+        Arguments:
+        - `self`:
+        - `n`: Number of entries
+        """
+        if self.done:
+            return False
+        lo     = None if self.last is None else self.last + 1
+        copied = 0
+        for rec in self.tree.scan(lo):
+            self.new._insert(rec.key, rec.desc)
+            self.last   = rec.key
+            self.copied = self.copied + 1
+            copied      = copied + 1
+            if copied == n:
+                return True
+        self.done = True
+        return False
+
+    def finish(self):
+        """Copy whatever is left, replay the changed keys into the new tree
+        and swap tree over to it, the new datafile is renamed to the old
+        path and the old blocks are gone.
+        
+        Arguments:
+        - `self`:
+        """
+        while self.step():
+            pass
+        tree = self.tree
+        new  = self.new
+        # Catch up, in key order so the new tree cursor moves forward
+        for key in sorted(self.changed):
+            rec = tree._lookup(key)
+            if not new._cursor.seek(key):
+                if rec is not None:
+                    new._insert(key, rec.desc)
+            elif rec is None:
+                new._cursor.delete(key)
+            elif new._cursor.record().desc != rec.desc:
+                new._cursor.update(rec.desc)
+            self.replayed = self.replayed + 1
+        self.changed = set()
+        # Swap, the new file takes the place of the old one
+        path    = tree._buf._datafile.path
+        newfile = new._buf._datafile
+        new._buf.flush_all()
+        newfile.close()
+        tree._buf._datafile.close()
+        if newfile.compress:
+            os.rename(newfile.path + ".z", path + ".z")
+        os.rename(newfile.path, path)
+        newfile.path = path
+        newfile.open()
+        new.path       = tree.path
+        new.split_fill = tree.split_fill
+        if new._descindex is not None:
+            new._descindex.path       = tree.path
+            new._descindex.split_fill = tree.split_fill
+        # Cursors on tree must not trust their paths into the old file
+        new._version = max(tree._version, new._version) + 1
+        tree.__dict__.update(new.__dict__)
+        tree._cursor    = Cursor(tree)
+        tree._compactor = None
+        # flush_all dropped the pins of the new tree
+        tree._refresh_pins()
+
+    def abort(self):
+        """Stop compacting and drop the new datafile, tree is left as is.
+        
+        Arguments:
+        - `self`:
+        """
+        newfile = self.new._buf._datafile
+        newfile.close()
+        if newfile.compress:
+            os.remove(newfile.path + ".z")
+        os.remove(newfile.path)
+        self.tree._compactor = None
+
+
+class DescIndex(BplusTree):
+    """Secondary index on record desc, a second tree in the buffer of its
+    BplusTree mapping desc keys to record pointers.
+
+    A desc key is the first DESCPREFIX bytes of desc followed by a 24 bit
+    crc of the whole desc, so exact lookups hit few entries and prefixes up
+    to DESCPREFIX bytes are a key range. Keys may repeat, the records are
+    always checked.
+    """
+
+    def __init__(self, tree):
+        """Create an empty index sharing tree buffer.
+        
+        Arguments:
+        - `tree`: The indexed BplusTree
+        """
+        self._setup(tree._buf, tree.path, 0, tree.split_fill, False)
+
+    def _refresh_pins(self):
+        """Pins belong to the indexed tree, which shares the buffer.
+        
+        Arguments:
+        - `self`:
+        """
+        pass
+
+    @staticmethod
+    def key(desc, fill="\x00", crc=None):
+        """Desc key of desc, see the class docstring.
+        
+        Arguments:
+        - `desc`: Record description
+        - `fill`: Pad byte of descs shorter than DESCPREFIX
+        - `crc`: Low 24 bits, default the crc of desc
+        """
+        prefix = desc[:DESCPREFIX].ljust(DESCPREFIX, fill)
+        if crc is None:
+            crc = zlib.crc32(desc) & 0xFFFFFF | 1
+        return (int(prefix.encode("hex"), 16) << 24) | crc
+
+    def add(self, key, pointer):
+        """Index the record at pointer under desc key.
+        
+        Arguments:
+        - `self`:
+        - `key`: Desc key of the record description
+        - `pointer`: Record pointer, (blocknum, offset)
+        """
+        self._cursor._locate(key)
+        self._insert_entry(self._cursor, key, pointer)
+
+    def remove(self, key, pointer):
+        """Drop the entry of the record at pointer, returns True if found.
+        
+        Arguments:
+        - `self`:
+        - `key`: Desc key the entry was added with
+        - `pointer`: Record pointer, (blocknum, offset)
+        """
+        for path, b in self._scan_leaves(key, key):
+            for i in xrange(bisect.bisect_left(b.keys, key), len(b.keys)):
+                if b.keys[i] != key:
+                    break
+                if b.pointers[i] == pointer:
+                    b.keys.pop(i)
+                    b.pointers.pop(i)
+                    b._resize()
+                    self._count(path, -1)
+                    return True
+        return False
+
+    def lookup(self, desc):
+        """Return the list of records with desc.
+        
+        Arguments:
+        - `self`:
+        - `desc`: Record description
+        """
+        key = self.key(desc)
+        return [r for r in self.scan(key, key) if r.desc == desc]
+
+    def scan_prefix(self, prefix):
+        """Generator, yields the records whose desc starts with prefix,
+        ordered by their first DESCPREFIX bytes.
+        
+        Arguments:
+        - `self`:
+        - `prefix`: Description prefix
+        """
+        lo = self.key(prefix, "\x00", 0)
+        hi = self.key(prefix, "\xff", 0xFFFFFF)
+        for r in self.scan(lo, hi):
+            if r.desc.startswith(prefix):
+                yield r
+
+
+class HashIndex(AccessMethod):
+    """An extendible hash access method, same insert/lookup/update/delete
+    API as BplusTree without the ordered operations. The directory block is
+    pinned, a lookup reads one bucket and one record block.
+    """
+
+    def __init__(self, path, pin_budget=MAXPINNED, cache_size=0,
+                 compress=False):
+        """Create a new HashIndex with a single bucket.
+        
+        Arguments:
+        - `path`: Buffer storage path
+        - `pin_budget`: Maximum number of pinned blocks
+        - `cache_size`: Number of records kept in a RecordCache, 0 for none
+        - `compress`: Keep blocks zlib compressed on disk
+        """
+        self._buf       = Buffer(path, pin_budget, compress=compress)
+        self.path       = path
+        self._cache     = RecordCache(cache_size) if cache_size else None
+        self.clustered  = False
+        self.reset_stats()
+        directory       = self._buf.alloc(DIRECTORY)
+        self.dirnum     = directory.blocknum
+        bucket          = self._buf.alloc(BUCKET)
+        directory       = self._buf.get_block(self.dirnum)
+        directory.buckets = [bucket.blocknum]
+        self._refresh_pins()
+
+    def reset_stats(self):
+        """Zero all counters, buffer and datafile included.
+        
+        Arguments:
+        - `self`:
+        """
+        AccessMethod.reset_stats(self)
+        self.splits = 0
+
+    def stats(self):
+        """Return a dict with lookup and insert latencies, directory and
+        bucket figures and the buffer (and datafile) counters.
+        
+        Arguments:
+        - `self`:
+        """
+        stats = {"lookup": self.lookup_time.stats(),
+                 "insert": self.insert_time.stats(),
+                 "depth": self._directory().depth,
+                 "buckets": len(set(self._directory().buckets)),
+                 "splits": self.splits,
+                 "buffer": self._buf.stats()}
+        if self._cache is not None:
+            stats["cache"] = self._cache.stats()
+        return stats
+
+    def _refresh_pins(self):
+        """Pin the directory block.
+        
+        Arguments:
+        - `self`:
+        """
+        self._buf.pin(self.dirnum)
+
+    def _directory(self):
+        """Fetch the directory block
+        
+        Arguments:
+        - `self`:
+        """
+        return self._buf.get_block(self.dirnum)
+
+    @staticmethod
+    def hash(key):
+        """64 bit mix of key, buckets are picked by its low bits.
+        
+        Arguments:
+        - `key`: Integer key
+        """
+        h = (key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        return h ^ (h >> 29)
+
+    def _bucket(self, key):
+        """Return the bucket block of key.
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        """
+        d = self._directory()
+        return self._buf.get_block(
+            d.buckets[self.hash(key) & ((1 << d.depth) - 1)])
+
+    def lookup(self, key):
+        """Lookup for a given record.
+        
+        Arguments:
+        - `self`:
+        - `key`: record key (pk)
+        """
+        start = time.time()
+        rec = self._lookup(key)
+        self.lookup_time.add(time.time() - start)
+        return rec
+
+    def _lookup(self, key):
+        """Lookup for a given record, not accounted in stats.
+        
+        Arguments:
+        - `self`:
+        - `key`: record key (pk)
+        """
+        cache = self._cache
+        if cache is not None:
+            rec = cache.get(key)
+            if rec is not None:
+                return rec
+        p = self._bucket(key).entries.get(key)
+        if p is None:
+            return None
+        rec = self._record(p)
+        if cache is not None:
+            cache.put(key, rec)
+        return rec
+
+    def multi_get(self, keys):
+        """Lookup many records at once, returns a list of records (or None)
+        in the same order as keys.
+        
+        Arguments:
+        - `self`:
+        - `keys`: Iterable of record keys
+        """
+        keys = list(keys)
+        entries = []
+        for key in keys:
+            p = self._bucket(key).entries.get(key)
+            if p is not None:
+                entries.append((key, p))
+        entries.sort(key=lambda x: x[1])
+        found = dict(zip([k for k, _ in entries],
+                         self._fetch_records(entries)))
+        return [found.get(key) for key in keys]
+
+    def insert(self, key, desc):
+        """Insert a record, returns it or None if key is already there.
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        - `desc`: Record desc
+        """
+        start = time.time()
+        ret = self._insert(key, desc)
+        self.insert_time.add(time.time() - start)
+        return ret
+
+    def _insert(self, key, desc):
+        """Insert a record, not accounted in stats.
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        - `desc`: Record desc
+        """
+        if self.readonly:
+            raise ValueError("insert on a readonly index")
+        if key < 1:
+            raise ValueError("Invalid key !!")
+        b = self._bucket(key)
+        if key in b.entries:
+            return None
+        while b.full():
+            self._split(b.blocknum)
+            b = self._bucket(key)
+        r, pointer = self._new_record(key, desc)
+        # The record alloc may have pushed the bucket out of the buffer
+        b = self._bucket(key)
+        b.entries[key] = pointer
+        b._refresh_fullness()
+        return r
+
+    def _split(self, bnum):
+        """Split bucket bnum in two on its next hash bit, doubling the
+        directory first if the bucket is as deep as the directory.
+        
+        Arguments:
+        - `self`:
+        - `bnum`: Bucket block number
+        """
+        d = self._directory()
+        b = self._buf.get_block(bnum)
+        if b.depth == d.depth:
+            if d.depth == MAXDIRDEPTH:
+                raise ValueError("Hash directory can't grow any more")
+            d.buckets = d.buckets + d.buckets
+            d.depth   = d.depth + 1
+        new = self._buf.alloc(BUCKET, bnum)
+        b   = self._buf.get_block(bnum)
+        bit = 1 << b.depth
+        for (k, p) in b.entries.items():
+            if self.hash(k) & bit:
+                new.entries[k] = p
+                del b.entries[k]
+        b.depth   = b.depth + 1
+        new.depth = b.depth
+        for i, n in enumerate(d.buckets):
+            if n == bnum and i & bit:
+                d.buckets[i] = new.blocknum
+        b._refresh_fullness()
+        new._refresh_fullness()
+        self.splits = self.splits + 1
+
+    def update(self, key, desc):
+        """Update a record of key to new desc, returns it or None.
+        
+        Arguments:
+        - `self`:
+        - `key`: Key of record
+        - `desc`: New description of record
+        """
+        if self.readonly:
+            raise ValueError("update on a readonly index")
+        p = self._bucket(key).entries.get(key)
+        if p is None:
+            return None
+        if self._cache is not None:
+            self._cache.invalidate(key)
+        newp = self._set_desc(p, desc)
+        if newp != p:
+            self._bucket(key).entries[key] = newp
+        return self._record(newp)
+
+    def delete(self, key):
+        """Delete the record of key, returns True if it was there. Buckets
+        are not merged.
+        
+        Arguments:
+        - `self`:
+        - `key`: Key of record
+        """
+        if self.readonly:
+            raise ValueError("delete on a readonly index")
+        if self._cache is not None:
+            self._cache.invalidate(key)
+        b = self._bucket(key)
+        p = b.entries.pop(key, None)
+        if p is None:
+            return False
+        b._refresh_fullness()
+        self._free_record(p)
+        return True
+
+
+def load_from_file(path, readonly=False, warm=False):
+    """Load a BplusTree (or HashIndex) from file and return the object
+    
+    Arguments:
+    - `path`: file path
+    - `readonly`: Open the datafile as a read-only shared mapping
+    - `warm`: True to reload the blocks resident at close, see
+    Buffer.warm_up, "background" to only get them into the page cache
+    """
+    f = open(path, "rb")
+    bp = pickle.load(f)
+    f.close()
+    bp._buf._datafile.open(readonly)
+    bp._refresh_pins()
+    if getattr(bp, "_bloom", None) is not None:
+        bp.rebuild_bloom()
+    if warm:
+        bp._buf.warm_up(warm == "background")
+
+    return bp
+
+# Read-only reader pool, fans lookups and scans out to worker processes, each
+# worker maps the same datafile read-only so nothing is copied.
+
+# The tree of a worker process
+_reader = None
+
+def _reader_init(path):
+    """Pool initializer, open the tree read-only in this worker.
+    
+    Arguments:
+    - `path`: BplusTree pickle path
+    """
+    global _reader
+    _reader = load_from_file(path, readonly=True)
+
+def _reader_multi_get(keys):
+    """Worker side multi_get, returns (key, desc) tuples or None.
+    
+    Arguments:
+    - `keys`: List of keys
+    """
+    return [(r.key, r.desc) if r else None for r in _reader.multi_get(keys)]
+
+def _reader_scan(bounds):
+    """Worker side scan, returns a list of (key, desc) tuples.
+    
+    Arguments:
+    - `bounds`: Tuple (lo, hi)
+    """
+    lo, hi = bounds
+    return [(r.key, r.desc) for r in _reader.scan(lo, hi)]
+
+
+class ReaderPool(object):
+    """A pool of processes with a read-only view of a closed BplusTree.
+    """
+
+    def __init__(self, path, processes=None):
+        """Start the pool.
+        
+        Arguments:
+        - `path`: BplusTree pickle path, as written by BplusTree.close()
+        - `processes`: Number of worker processes, defaults to cpu count
+        """
+        self.path      = path
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool     = multiprocessing.Pool(self.processes, _reader_init,
+                                              (path,))
+
+    def close(self):
+        """Stop all workers.
+        
+        Arguments:
+        - `self`:
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def _chunks(self, seq):
+        """Split seq in one contiguous chunk per process.
+        
+        Arguments:
+        - `self`:
+        - `seq`: A list
+        """
+        n = max(1, (len(seq) + self.processes - 1) / self.processes)
+        return [seq[i:i + n] for i in xrange(0, len(seq), n)]
+
+    def lookup(self, key):
+        """Lookup a single key, returns (key, desc) or None.
+        
+        Arguments:
+        - `self`:
+        - `key`: record key (pk)
+        """
+        return self.multi_get([key])[0]
+
+    def multi_get(self, keys):
+        """Lookup many keys across all workers, results keep keys order.
+        
+        Arguments:
+        - `self`:
+        - `keys`: Iterable of keys
+        """
+        result = []
+        for part in self._pool.map(_reader_multi_get, self._chunks(list(keys))):
+            result.extend(part)
+        return result
+
+    def scan(self, lo, hi):
+        """Scan lo <= key <= hi, the range is cut in one piece per worker.
+        
+        Arguments:
+        - `self`:
+        - `lo`: Lowest key
+        - `hi`: Highest key
+        """
+        step   = max(1, (hi - lo + self.processes) / self.processes)
+        bounds = [(x, min(x + step - 1, hi)) for x in xrange(lo, hi + 1, step)]
+        result = []
+        for part in self._pool.map(_reader_scan, bounds):
+            result.extend(part)
+        return result
+
+# Partitioned trees, keys are spread over several independent trees, each with
+# its own datafile, either by hash or by key range.
+
+def _partition_load(args):
+    """Worker side bulk load of a single partition.
+    
+    Arguments:
+    - `args`: Tuple (pickle path, list of (key, desc))
+    """
+    path, items = args
+    bp = load_from_file(path)
+    items.sort()
+    for key, desc in items:
+        bp.insert(key, desc)
+    bp.close()
+    return len(items)
+
+def _partition_multi_get(args):
+    """Worker side multi_get on a single partition, returns Records or
+    None.
+    
+    Arguments:
+    - `args`: Tuple (pickle path, list of keys)
+    """
+    path, keys = args
+    bp = load_from_file(path, readonly=True)
+    result = bp.multi_get(keys)
+    bp.close()
+    return result
+
+def _partition_scan(args):
+    """Worker side scan on a single partition, returns a list of Records.
+    
+    Arguments:
+    - `args`: Tuple (pickle path, lo, hi)
+    """
+    path, lo, hi = args
+    bp = load_from_file(path, readonly=True)
+    result = list(bp.scan(lo, hi))
+    bp.close()
+    return result
+
+
+class PartitionedTree(object):
+    """N BplusTrees over N datafiles, point operations are routed to the
+    owning partition, bulk operations run on a process pool.
+    """
+
+    def __init__(self, path, partitions=4, bounds=None, processes=None):
+        """Create partitions path.0 ... path.N-1.
+        
+        Arguments:
+        - `path`: Datafile path prefix
+        - `partitions`: Number of partitions, ignored if bounds is given
+        - `bounds`: Sorted list of split keys for range partitioning, key k
+        goes to partition bisect_right(bounds, k), None means hash partitioning
+        - `processes`: Pool size, defaults to the number of partitions
+        """
+        if bounds is not None:
+            bounds     = sorted(bounds)
+            partitions = len(bounds) + 1
+        self._setup(path, partitions, bounds, processes)
+        self._trees    = [BplusTree(p) for p in self.paths]
+        # Nothing is on disk yet
+        self._dirty    = set(xrange(partitions))
+        # The layout is needed to find the partitions again, see load()
+        f = open(path + ".parts", "w")
+        pickle.dump({"partitions": partitions, "bounds": bounds}, f)
+        f.close()
+
+    @classmethod
+    def load(cls, path, processes=None):
+        """Open the partitions of a closed PartitionedTree.
+        
+        Arguments:
+        - `path`: Datafile path prefix, as given to the constructor
+        - `processes`: Pool size, defaults to the number of partitions
+        """
+        f = open(path + ".parts", "rb")
+        layout = pickle.load(f)
+        f.close()
+        pt = cls.__new__(cls)
+        pt._setup(path, layout["partitions"], layout["bounds"], processes)
+        pt._trees = [load_from_file(p + ".pickle") for p in pt.paths]
+        return pt
+
+    def _setup(self, path, partitions, bounds, processes):
+        """Set everything but the trees.
+        
+        Arguments:
+        - `self`:
+        - `path`: Datafile path prefix
+        - `partitions`: Number of partitions
+        - `bounds`: Sorted split keys, or None
+        - `processes`: Pool size, defaults to the number of partitions
+        """
+        self.path      = path
+        self.bounds    = bounds
+        self.paths     = ["{0}.{1}".format(path, i) for i in xrange(partitions)]
+        self.processes = processes or partitions
+        self._trees    = []
+        self._pool     = None
+        # Partitions written since they were last on disk
+        self._dirty    = set()
+
+    def __len__(self):
+        return len(self._trees)
+
+    def partition(self, key):
+        """Return the partition number which owns key.
+        
+        Arguments:
+        - `self`:
+        - `key`: record key (pk)
+        """
+        if self.bounds is not None:
+            return bisect.bisect_right(self.bounds, key)
+        return hash(key) % len(self._trees)
+
+    def get_tree(self, key):
+        """Return the BplusTree which owns key.
+        
+        Arguments:
+        - `self`:
+        - `key`: record key (pk)
+        """
+        return self._trees[self.partition(key)]
+
+    def lookup(self, key):
+        """Lookup for a given record.
+        
+        Arguments:
+        - `self`:
+        - `key`: record key (pk)
+        """
+        return self.get_tree(key).lookup(key)
+
+    def insert(self, key, desc):
+        """Insert a record on the owning partition.
+        
+        Arguments:
+        - `self`:
+        - `key`: Record key
+        - `desc`: Record desc
+        """
+        i = self.partition(key)
+        r = self._trees[i].insert(key, desc)
+        if r is not None:
+            self._dirty.add(i)
+        return r
+
+    def update(self, key, desc):
+        """Update a record of key to new desc
+        
+        Arguments:
+        - `self`:
+        - `key`: Key of record
+        - `desc`: New description of record
+        """
+        i = self.partition(key)
+        r = self._trees[i].update(key, desc)
+        if r is not None:
+            self._dirty.add(i)
+        return r
+
+    def delete(self, key):
+        """Delete the record of key, returns True if it was there.
+        
+        Arguments:
+        - `self`:
+        - `key`: Key of record
+        """
+        i = self.partition(key)
+        r = self._trees[i].delete(key)
+        if r:
+            self._dirty.add(i)
+        return r
+
+    def count(self, lo=None, hi=None):
+        """Number of keys with lo <= key <= hi over all partitions.
+        
+        Arguments:
+        - `self`:
+        - `lo`: Lowest key
+        - `hi`: Highest key
+        """
+        return sum(bp.count(lo, hi) for bp in self._trees)
+
+    def _get_pool(self):
+        """Get the process pool, started on first use.
+        
+        Arguments:
+        - `self`:
+        """
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        return self._pool
+
+    def _split(self, keys):
+        """Group keys by partition, returns a list of lists.
+        
+        Arguments:
+        - `self`:
+        - `keys`: Iterable of keys, or of (key, ...) tuples
+        """
+        parts = [[] for _ in self._trees]
+        for k in keys:
+            if type(k) is types.TupleType:
+                parts[self.partition(k[0])].append(k)
+            else:
+                parts[self.partition(k)].append(k)
+        return parts
+
+    def sync(self):
+        """Write the partitions changed since the last sync to disk so
+        worker processes see all data, those trees are reopened afterwards.
+        The others keep their buffers.
+        
+        Arguments:
+        - `self`:
+        """
+        for i in sorted(self._dirty):
+            self._trees[i].close()
+            self._trees[i] = load_from_file(self.paths[i] + ".pickle")
+        self._dirty = set()
+
+    def bulk_load(self, items):
+        """Insert many (key, desc) items, each partition is loaded by its
+        own process. Returns the number of items given.
+        
+        Arguments:
+        - `self`:
+        - `items`: Iterable of (key, desc)
+        """
+        parts = self._split(items)
+        for bp in self._trees:
+            bp.close()
+        args = [(p + ".pickle", part) for p, part in zip(self.paths, parts)]
+        n = sum(self._get_pool().map(_partition_load, args))
+        self._trees = [load_from_file(p + ".pickle") for p in self.paths]
+        self._dirty = set()
+        return n
+
+    def multi_get(self, keys):
+        """Lookup many keys, partitions are queried in parallel. Returns
+        Records or None in the same order as keys, like BplusTree.multi_get.
+        
+        Arguments:
+        - `self`:
+        - `keys`: Iterable of keys
+        """
+        keys = list(keys)
+        self.sync()
+        parts = self._split(keys)
+        args = [(p + ".pickle", part) for p, part in zip(self.paths, parts)]
+        found = {}
+        for part, res in zip(parts, self._get_pool().map(_partition_multi_get,
+                                                          args)):
+            found.update(zip(part, res))
+        return [found[k] for k in keys]
+
+    def scan(self, lo=None, hi=None):
+        """Scan lo <= key <= hi over all partitions in parallel, returns a
+        list of the Records in key order.
+        
+        Arguments:
+        - `self`:
+        - `lo`: Lowest key, None for unbounded
+        - `hi`: Highest key, None for unbounded
+        """
+        self.sync()
+        args = [(p + ".pickle", lo, hi) for p in self.paths]
+        parts = self._get_pool().map(_partition_scan, args)
+        # Range partitions are already in order
+        if self.bounds is not None:
+            return [r for part in parts for r in part]
+        merged = heapq.merge(*[[(r.key, r) for r in part] for part in parts])
+        return [r for (_, r) in merged]
+
+    def close(self):
+        """Close all partitions and stop the pool.
+        
+        Arguments:
+        - `self`:
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for bp in self._trees:
+            bp.close()
+        self._trees = []
+        self._dirty = set()
+
+# Index rebuild, the leaves and branches are thrown away and built again from
+# the keys found in the record blocks.
+
+def _rebuild_scan(args):
+    """Worker side scan of some record blocks, writes their (key, blocknum,
+    slot) entries sorted by key to a run file. Returns the number of
+    entries.
+    
+    Arguments:
+    - `args`: Tuple (pickle path, list of record blocknums, run path, True
+    to write the desc keys to run path + ".desc" as well)
+    """
+    path, blocknums, runpath, descs = args
+    f = open(path, "rb")
+    bp = pickle.load(f)
+    f.close()
+    datafile = bp._buf._datafile
+    datafile.open(readonly=True)
+    entries  = []
+    dentries = []
+    for bnum in blocknums:
+        data = datafile.read_block(bnum)
+        (nslots, _) = struct.unpack_from("HH", data, 0)
+        for x in xrange(nslots):
+            off, length = struct.unpack_from("HH", data,
+                                             RECORDHEADER + x * RECORDSLOT)
+            if not off:
+                continue
+            (key,) = struct.unpack_from("Q", data, off)
+            entries.append((key, bnum, x))
+            if not descs:
+                continue
+            if length & OVERFLOWFLAG:
+                (_, first, _) = struct.unpack_from("QiI", data, off)
+                desc = datafile.read_chain(first)
+            else:
+                desc = str(data[off + 8:off + length])
+            dentries.append((DescIndex.key(desc), bnum, x))
+    datafile.close()
+    _write_run(runpath, entries)
+    if descs:
+        _write_run(runpath + ".desc", dentries)
+    return len(entries)
+
+def _write_run(path, entries):
+    """Sort (key, blocknum, slot) entries and write them to a run file.
+    
+    Arguments:
+    - `path`: Run file path
+    - `entries`: List of (key, blocknum, slot)
+    """
+    entries.sort()
+    f = open(path, "wb")
+    f.write(''.join(struct.pack("=QHH", *e) for e in entries))
+    f.close()
+
+def _read_run(path):
+    """Generator, yields the (key, pointer) entries of a run file, RUNREAD
+    at a time are read.
+    
+    Arguments:
+    - `path`: Run file path
+    """
+    f = open(path, "rb")
+    while True:
+        data = f.read(RUNENTRY * RUNREAD)
+        if not data:
+            break
+        for i in xrange(0, len(data), RUNENTRY):
+            (key, bnum, slot) = struct.unpack_from("=QHH", data, i)
+            yield key, (bnum, slot)
+    f.close()
+
+def rebuild_index(path, processes=None):
+    """Rebuild the leaves and branches (and the desc_index, if any) of a
+    closed BplusTree from its record blocks, for damaged index blocks or a
+    changed index layout. The record blocks are scanned by a process pool,
+    each worker sorts its share into a run file, the runs are merged and
+    the new levels bulk loaded, filled up and in key order. Returns the
+    tree, open.
+    
+    Arguments:
+    - `path`: BplusTree pickle path, as written by BplusTree.close()
+    - `processes`: Number of worker processes, defaults to cpu count
+    """
+    f = open(path, "rb")
+    bp = pickle.load(f)
+    f.close()
+    if not isinstance(bp, BplusTree) or bp.clustered:
+        raise ValueError("rebuild_index needs a tree with RecordBlocks")
+    datafile = bp._buf._datafile
+    datafile.open()
+    records  = [b for (b, (btype, _, _)) in enumerate(datafile._blocks)
+                if btype == RECORD]
+    chunks   = [records[i:i + REBUILDBLOCKS]
+                for i in xrange(0, len(records), REBUILDBLOCKS)]
+    runs     = ["{0}.run{1}".format(datafile.path, i)
+                for i in xrange(len(chunks))]
+    descs    = bp._descindex is not None
+    pool     = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        pool.map(_rebuild_scan, [(path, chunk, run, descs)
+                                 for chunk, run in zip(chunks, runs)])
+    finally:
+        pool.close()
+        pool.join()
+    # Nothing of the old index is read from here on
+    for (b, (btype, _, _)) in enumerate(datafile._blocks):
+        if btype in (LEAF, BRANCH):
+            datafile.free(b)
+    datafile.release_extents()
+    bp._bulk_load(heapq.merge(*[_read_run(run) for run in runs]))
+    if descs:
+        bp._descindex._bulk_load(heapq.merge(*[_read_run(run + ".desc")
+                                               for run in runs]))
+    for run in runs:
+        os.remove(run)
+        if descs:
+            os.remove(run + ".desc")
+    bp._version = bp._version + 1
+    bp._cursor  = Cursor(bp)
+    if descs:
+        bp._descindex._version = bp._descindex._version + 1
+        bp._descindex._cursor  = Cursor(bp._descindex)
+    bp._refresh_pins()
+    bp.rebuild_bloom()
     return bp
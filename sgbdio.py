@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""
+ Copyright (c) 2011 Christiano F. Haesbaert <haesbaert@haesbaert.org>
+
+ Permission to use, copy, modify, and distribute this software for any
+ purpose with or without fee is hereby granted, provided that the above
+ copyright notice and this permission notice appear in all copies.
+
+ THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+ WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+ MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+ ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+ WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+ ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+ OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+"""
+Bulk import and export of sgbd2 trees.
+
+ sgbdio.py import tree.db [input] [--format csv|bin] [--batch N]
+ sgbdio.py export tree.db [output] [--format csv|bin] [--lo K] [--hi K]
+
+Input and output default to stdin and stdout. csv rows are key,desc. The
+bin format is a sequence of records, each a struct "=QI" key and desc
+length followed by the desc bytes. Both directions stream, import holds a
+single batch of records at a time, export walks the tree with scan().
+Rows/sec and bytes/sec go to stderr every --every seconds and at the end.
+
+import opens tree.db.pickle if there is one, else creates a new tree.
+"""
+import os
+import sys
+import csv
+import time
+import struct
+import argparse
+
+import sgbd2
+
+# Header of a bin record, key and desc length
+BINHEADER = struct.Struct("=QI")
+# Records inserted per insert_many
+BATCH = 4096
+
+
+class Progress(object):
+    """Counts rows and bytes, reports throughput to stderr now and then.
+    """
+
+    def __init__(self, what, every=1.0):
+        """Start counting.
+
+        Arguments:
+        - `what`: Name printed on every line
+        - `every`: Seconds between reports
+        """
+        self.what  = what
+        self.every = every
+        self.rows  = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last  = self.start
+
+    def add(self, rows, nbytes):
+        """Account rows and bytes, report if it is time to.
+
+        Arguments:
+        - `rows`: Number of rows
+        - `nbytes`: Number of bytes
+        """
+        self.rows  = self.rows + rows
+        self.bytes = self.bytes + nbytes
+        now = time.time()
+        if now - self.last >= self.every:
+            self.last = now
+            self.report()
+
+    def report(self, final=False):
+        """Write a throughput line to stderr.
+
+        Arguments:
+        - `final`: True for the last line
+        """
+        elapsed = max(time.time() - self.start, 1e-9)
+        sys.stderr.write("{0} {1}{2} rows {3:.1f}s {4:.0f} rows/s "
+                         "{5:.0f} bytes/s\n".format(
+                self.what, "done " if final else "", self.rows, elapsed,
+                self.rows / elapsed, self.bytes / elapsed))
+
+
+def read_csv(f):
+    """Generator, yields (key, desc, bytes) of each csv row.
+
+    Arguments:
+    - `f`: Input file
+    """
+    for row in csv.reader(f):
+        if not row:
+            continue
+        if len(row) != 2:
+            raise ValueError("csv row {0!r} is not key,desc".format(row))
+        yield int(row[0]), row[1], len(row[0]) + len(row[1]) + 2
+
+def read_bin(f):
+    """Generator, yields (key, desc, bytes) of each bin record.
+
+    Arguments:
+    - `f`: Input file
+    """
+    while True:
+        head = f.read(BINHEADER.size)
+        if not head:
+            break
+        if len(head) < BINHEADER.size:
+            raise ValueError("truncated bin record header")
+        key, length = BINHEADER.unpack(head)
+        desc = f.read(length)
+        if len(desc) < length:
+            raise ValueError("truncated bin record {0}".format(key))
+        yield key, desc, BINHEADER.size + length
+
+def write_csv(f, key, desc):
+    """Write a csv row, returns the bytes written.
+
+    Arguments:
+    - `f`: Output file
+    - `key`: Record key
+    - `desc`: Record desc
+    """
+    line = "{0},{1}\r\n".format(key, desc)
+    if any(c in desc for c in ",\"\r\n"):
+        line = "{0},\"{1}\"\r\n".format(key, desc.replace("\"", "\"\""))
+    f.write(line)
+    return len(line)
+
+def write_bin(f, key, desc):
+    """Write a bin record, returns the bytes written.
+
+    Arguments:
+    - `f`: Output file
+    - `key`: Record key
+    - `desc`: Record desc
+    """
+    f.write(BINHEADER.pack(key, len(desc)))
+    f.write(desc)
+    return BINHEADER.size + len(desc)
+
+READERS = {"csv": read_csv, "bin": read_bin}
+WRITERS = {"csv": write_csv, "bin": write_bin}
+
+def open_tree(path, readonly=False):
+    """Load the tree of path, or create it if it was never closed.
+
+    Arguments:
+    - `path`: Datafile path
+    - `readonly`: Open read-only
+    """
+    if os.path.exists(path + ".pickle"):
+        return sgbd2.load_from_file(path + ".pickle", readonly)
+    if readonly:
+        raise ValueError("no tree at {0}".format(path))
+    return sgbd2.BplusTree(path)
+
+def do_import(args):
+    """The import command.
+
+    Arguments:
+    - `args`: Parsed arguments
+    """
+    f = sys.stdin if args.input == "-" else open(args.input, "rb")
+    tree = open_tree(args.path)
+    progress = Progress("import", args.every)
+    inserted = 0
+    batch = []
+    nbytes = 0
+    for key, desc, size in READERS[args.format](f):
+        batch.append((key, desc))
+        nbytes = nbytes + size
+        if len(batch) < args.batch:
+            continue
+        inserted = inserted + tree.insert_many(batch)
+        progress.add(len(batch), nbytes)
+        batch = []
+        nbytes = 0
+    inserted = inserted + tree.insert_many(batch)
+    progress.add(len(batch), nbytes)
+    tree.close()
+    if f is not sys.stdin:
+        f.close()
+    progress.report(True)
+    if inserted != progress.rows:
+        sys.stderr.write("import {0} duplicate keys skipped\n".format(
+                progress.rows - inserted))
+    return 0
+
+def do_export(args):
+    """The export command.
+
+    Arguments:
+    - `args`: Parsed arguments
+    """
+    f = sys.stdout if args.output == "-" else open(args.output, "wb")
+    tree = open_tree(args.path, readonly=True)
+    progress = Progress("export", args.every)
+    write = WRITERS[args.format]
+    for rec in tree.scan(args.lo, args.hi):
+        progress.add(1, write(f, rec.key, rec.desc))
+    tree.close()
+    if f is not sys.stdout:
+        f.close()
+    progress.report(True)
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="sgbd2 import and export")
+    sub = parser.add_subparsers()
+
+    p = sub.add_parser("import", help="load records into a tree")
+    p.add_argument("path", help="datafile path")
+    p.add_argument("input", nargs="?", default="-",
+                   help="input file, - for stdin")
+    p.add_argument("--format", choices=sorted(READERS), default="csv")
+    p.add_argument("--batch", type=int, default=BATCH,
+                   help="records per insert_many")
+    p.add_argument("--every", type=float, default=1.0,
+                   help="seconds between progress reports")
+    p.set_defaults(func=do_import)
+
+    p = sub.add_parser("export", help="write the records of a tree")
+    p.add_argument("path", help="datafile path")
+    p.add_argument("output", nargs="?", default="-",
+                   help="output file, - for stdout")
+    p.add_argument("--format", choices=sorted(WRITERS), default="csv")
+    p.add_argument("--lo", type=int, default=None, help="lowest key")
+    p.add_argument("--hi", type=int, default=None, help="highest key")
+    p.add_argument("--every", type=float, default=1.0,
+                   help="seconds between progress reports")
+    p.set_defaults(func=do_export)
+
+    args = parser.parse_args(argv[1:])
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
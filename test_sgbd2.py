@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+
+"""
+Regression tests for sgbd2, run with python -m unittest test_sgbd2
+"""
+import bisect
+import os
+import shutil
+import tempfile
+import unittest
+
+import sgbd2
+import sgbdio
+
+
+class DescIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_non_ascii_desc(self):
+        t = sgbd2.BplusTree(self.path, desc_index=True)
+        descs = {2: "\xe9t\xe9", 3: "\xff\xff\xff\xff\xff\xff", 4: "\x80"}
+        for key, desc in descs.iteritems():
+            t.insert(key, desc)
+        for key, desc in descs.iteritems():
+            self.assertEqual([r.key for r in t.lookup_by_desc(desc)], [key])
+        self.assertEqual([r.key for r in t.scan_desc_prefix("\xff")], [3])
+        t.update(2, "\xfe" * 3)
+        self.assertEqual(t.lookup_by_desc("\xe9t\xe9"), [])
+        self.assertEqual([r.key for r in t.lookup_by_desc("\xfe" * 3)], [2])
+        self.assertTrue(t.delete(3))
+        self.assertEqual(t.lookup_by_desc(descs[3]), [])
+        self.assertEqual(t.count(), 2)
+        t.close()
+
+    def test_remove_resizes_leaf(self):
+        t = sgbd2.BplusTree(self.path, desc_index=True)
+        for key in xrange(1, 1000):
+            t.insert(key, "desc {0}".format(key))
+        for key in xrange(1, 1000, 2):
+            t.delete(key)
+        for _, b in t._descindex._scan_leaves():
+            self.assertEqual(b.size, sgbd2.LEAFHEADER +
+                             sgbd2.LEAFPOINTER * len(b.keys) +
+                             sgbd2.keys_len(b.keys))
+        t.close()
+
+    def insert_duplicates(self, t):
+        descs = {}
+        for key in xrange(1, 6000):
+            descs[key] = "same" if key % 3 else "d{0}".format(key % 200)
+            t.insert(key, descs[key])
+        return sorted(t._descindex.key(d) for d in descs.itervalues())
+
+    def subtree_count(self, index, b):
+        if b.blocktype != sgbd2.BRANCH:
+            return len(b.keys)
+        total = 0
+        for pointer, count in zip(b.pointers, b.counts):
+            self.assertEqual(
+                self.subtree_count(index, index._buf.get_block(pointer)), count)
+            total = total + count
+        return total
+
+    def test_duplicate_counts(self):
+        t = sgbd2.BplusTree(self.path, desc_index=True)
+        keys = self.insert_duplicates(t)
+        index = t._descindex
+        self.assertEqual(self.subtree_count(index, index.get_root()), len(keys))
+        for key in xrange(1, 6000, 4):
+            t.delete(key)
+        self.assertEqual(self.subtree_count(index, index.get_root()),
+                         index.count())
+        left = [k for k in xrange(1, 6000) if k % 3 and k % 4 != 1]
+        self.assertEqual(len(t.lookup_by_desc("same")), len(left))
+        t.close()
+
+    def test_duplicate_rank(self):
+        t = sgbd2.BplusTree(self.path, desc_index=True)
+        keys = self.insert_duplicates(t)
+        index = t._descindex
+        same = index.key("same")
+        self.assertEqual(index.count(), len(keys))
+        self.assertEqual(index.count(same, same), keys.count(same))
+        self.assertEqual(index.count(keys[0], same),
+                         bisect.bisect_right(keys, same))
+        for key in (same, same + 1, keys[0], keys[-1] + 1, keys[1000]):
+            self.assertEqual(index.rank(key), bisect.bisect_left(keys, key))
+        descs = [index.select(k).desc for k in xrange(0, len(keys), 7)]
+        self.assertEqual([index.key(d) for d in descs], keys[::7])
+        first = keys.index(same)
+        self.assertEqual(len(set(index.select(k).key
+                                 for k in xrange(first, first + 50))), 50)
+        t.close()
+
+
+class HashIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "h.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_operations(self):
+        h = sgbd2.HashIndex(self.path)
+        for key in xrange(1, 5000):
+            h.insert(key * 7919, "desc {0}".format(key))
+        self.assertEqual(h.insert(7919, "again"), None)
+        self.assertTrue(h.stats()["splits"] > 0)
+        self.assertEqual(h.lookup(7919 * 20).desc, "desc 20")
+        self.assertEqual(h.lookup(3), None)
+        h.update(7919 * 30, "new")
+        self.assertTrue(h.delete(7919 * 40))
+        self.assertFalse(h.delete(7919 * 40))
+        self.assertEqual([r and r.desc for r in
+                          h.multi_get([7919 * 30, 7919 * 40, 7919 * 50])],
+                         ["new", None, "desc 50"])
+        h.close()
+        h = sgbd2.load_from_file(self.path + ".pickle")
+        self.assertTrue(isinstance(h, sgbd2.HashIndex))
+        self.assertEqual(h.lookup(7919 * 30).desc, "new")
+        self.assertEqual(h.lookup(7919 * 40), None)
+        self.assertEqual(h.lookup(7919 * 4999).desc, "desc 4999")
+        h.close()
+
+
+class ClusteredTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_long_desc_refused(self):
+        t = sgbd2.BplusTree(self.path, clustered=True)
+        desc = "x" * sgbd2.DATALEAFDESC
+        t.insert(1, desc)
+        self.assertRaises(ValueError, t.insert, 2, desc + "x")
+        self.assertRaises(ValueError, t.update, 1, desc + "x")
+        self.assertEqual(t.count(), 1)
+        t.close()
+        t = sgbd2.load_from_file(self.path + ".pickle")
+        self.assertEqual(t.lookup(1).desc, desc)
+        self.assertEqual(t.lookup(2), None)
+        t.close()
+
+
+class CompactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_compact_keeps_pins(self):
+        t = sgbd2.BplusTree(self.path)
+        for key in xrange(1, 10000):
+            t.insert(key * 7919 % 1000003, "desc {0}".format(key))
+        self.assertTrue(t._buf.pinned())
+        t.compact()
+        self.assertTrue(t.rootnum in t._buf.pinned())
+        self.assertEqual(t.count(), 9999)
+        t.close()
+
+
+class CompressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_tree(self):
+        t = sgbd2.BplusTree(self.path, compress=True)
+        for key in xrange(1, 5000):
+            t.insert(key, "desc {0}".format(key))
+        t.close()
+        t = sgbd2.load_from_file(self.path + ".pickle")
+        self.assertTrue(t._buf._datafile.stats()["compressed"] > 0)
+        self.assertEqual(t.lookup(1234).desc, "desc 1234")
+        self.assertEqual(t.count(), 4999)
+        t.close()
+
+    def test_free_merges_sectors(self):
+        datafile = sgbd2.DataFile(self.path, compress=True)
+        blocks = [datafile.alloc(sgbd2.RECORD) for _ in xrange(6)]
+        # One sector blocks and two sector blocks, alternating
+        for i, b in enumerate(blocks):
+            datafile.write_block(b, os.urandom(200 + 500 * (i % 2)))
+        self.assertEqual(datafile._zend, 9)
+        for b in blocks[1:4]:
+            datafile.free(b)
+        self.assertEqual(datafile._zfree, {1: 5})
+        self.assertFalse(datafile.compressed(blocks[2]))
+        self.assertEqual(datafile.read_block(blocks[2]),
+                         "\x00" * sgbd2.BLOCKSIZE)
+        # Freeing the tail shrinks the heap, merging the free run
+        datafile.free(blocks[5])
+        datafile.free(blocks[4])
+        self.assertEqual(datafile._zfree, {})
+        self.assertEqual(datafile._zend, 1)
+        b = datafile.alloc(sgbd2.RECORD)
+        datafile.write_block(b, os.urandom(700))
+        self.assertEqual(datafile._zmap[b], (1, datafile._zmap[b][1]))
+        datafile.close()
+
+
+class RebuildIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_rebuild(self):
+        t = sgbd2.BplusTree(self.path, desc_index=True)
+        for key in xrange(1, 8000):
+            t.insert(key * 7919 % 100003, "desc {0}".format(key % 500))
+        for key in xrange(1, 8000, 5):
+            t.delete(key * 7919 % 100003)
+        keys = [r.key for r in t.scan()]
+        t.close()
+        t = sgbd2.rebuild_index(self.path + ".pickle", processes=2)
+        self.assertEqual([r.key for r in t.scan()], keys)
+        self.assertEqual(t.count(), len(keys))
+        self.assertEqual(t.lookup(7919 * 2 % 100003).desc, "desc 2")
+        self.assertEqual(t.lookup(7919 % 100003), None)
+        self.assertEqual(len(t.lookup_by_desc("desc 7")),
+                         len([k for k in xrange(7, 8000, 500) if k % 5 != 1]))
+        t.insert(3, "three")
+        t.close()
+        t = sgbd2.load_from_file(self.path + ".pickle")
+        self.assertEqual(t.lookup(3).desc, "three")
+        self.assertEqual(t.count(), len(keys) + 1)
+        t.close()
+
+
+class SgbdioTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_io(self, *args):
+        self.assertEqual(sgbdio.main(["sgbdio.py"] + list(args) +
+                                     ["--every", "3600"]), 0)
+
+    def test_csv(self):
+        rows = dict((key, "desc {0}".format(key)) for key in xrange(1, 3000))
+        rows[5] = 'a, "quoted" desc'
+        src = os.path.join(self.dir, "in.csv")
+        f = open(src, "wb")
+        for key in sorted(rows, reverse=True):
+            sgbdio.write_csv(f, key, rows[key])
+        f.close()
+        self.run_io("import", self.path, src, "--batch", "500")
+        out = os.path.join(self.dir, "out.csv")
+        self.run_io("export", self.path, out, "--lo", "2", "--hi", "10")
+        f = open(out, "rb")
+        self.assertEqual([(k, d) for k, d, _ in sgbdio.read_csv(f)],
+                         [(k, rows[k]) for k in xrange(2, 11)])
+        f.close()
+
+    def test_bin(self):
+        rows = [(key, "\x00\n," * (key % 7)) for key in xrange(1, 2000)]
+        src = os.path.join(self.dir, "in.bin")
+        f = open(src, "wb")
+        for key, desc in rows:
+            sgbdio.write_bin(f, key, desc)
+        f.close()
+        # Importing twice skips the keys already in
+        self.run_io("import", self.path, src, "--format", "bin")
+        self.run_io("import", self.path, src, "--format", "bin")
+        out = os.path.join(self.dir, "out.bin")
+        self.run_io("export", self.path, out, "--format", "bin")
+        f = open(out, "rb")
+        self.assertEqual([(k, d) for k, d, _ in sgbdio.read_bin(f)], rows)
+        f.close()
+
+
+class BufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_pinned_hits(self):
+        t = sgbd2.BplusTree(self.path)
+        for key in xrange(1, 5000):
+            t.insert(key, "desc {0}".format(key))
+        t.reset_stats()
+        # Far apart keys, every lookup goes down from the pinned root
+        for key in xrange(1, 2500, 10):
+            t.lookup(key)
+            t.lookup(5000 - key)
+        stats = t._buf.stats()
+        self.assertTrue(t.rootnum in t._buf.pinned())
+        self.assertTrue(stats["pinned_hits"] >= t.descents >= 250)
+        self.assertEqual(stats["hit_rate"],
+                         float(stats["hits"] + stats["pinned_hits"]) /
+                         (stats["hits"] + stats["pinned_hits"] +
+                          stats["misses"]))
+        t.close()
+
+
+class RecordHeapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_room_hint(self):
+        t = sgbd2.BplusTree(self.path)
+        for key in xrange(1, 5000):
+            t.insert(key, "{0:60d}".format(key))
+        # A little room in every record block, not enough for a long desc
+        for key in xrange(1, 5000, 50):
+            t.delete(key)
+        t.close()
+        t = sgbd2.load_from_file(self.path + ".pickle")
+        t.reset_stats()
+        t.insert(10000, "x" * 500)
+        self.assertEqual(t._buf._parts[sgbd2.RECORD].misses, 1)
+        self.assertEqual(t.lookup(10000).desc, "x" * 500)
+        t.insert(10001, "y")
+        self.assertEqual(t._buf._parts[sgbd2.RECORD].misses, 2)
+        t.close()
+
+
+class WarmStartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+        t = sgbd2.BplusTree(self.path)
+        for key in xrange(1, 20000):
+            t.insert(key, "desc {0}".format(key))
+        t.close()
+        t = sgbd2.load_from_file(self.path + ".pickle")
+        self.hot = range(5000, 6000, 7)
+        for key in self.hot:
+            t.lookup(key)
+        self.resident = set(t._buf.resident())
+        t.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_warm(self):
+        t = sgbd2.load_from_file(self.path + ".pickle", warm=True)
+        self.assertEqual(set(t._buf.resident()), self.resident)
+        t.reset_stats()
+        for key in self.hot:
+            self.assertEqual(t.lookup(key).desc, "desc {0}".format(key))
+        self.assertEqual(t._buf.misses, 0)
+        t.close()
+
+    def test_background(self):
+        t = sgbd2.load_from_file(self.path + ".pickle")
+        self.assertEqual(t._buf.resident(), [])
+        thread = t._buf._datafile.willneed(self.resident)
+        if thread is not None:
+            thread.join()
+        self.assertEqual(t._buf.warm_up(True), len(self.resident))
+        self.assertEqual(t._buf.resident(), [])
+        t.close()
+
+
+class ReadaheadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "t.db")
+        t = sgbd2.BplusTree(self.path)
+        for key in xrange(1, 30001):
+            t.insert(key, "desc {0}".format(key))
+        t.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sequential_blocks(self):
+        t = sgbd2.load_from_file(self.path + ".pickle")
+        datafile = t._buf._datafile
+        records = [b for b in xrange(sgbd2.BLOCKNUM)
+                   if datafile.get_meta(b)[0] == sgbd2.RECORD]
+        t.reset_stats()
+        for b in records:
+            t._buf.get_block(b)
+        self.assertEqual(t._buf.misses, len(records))
+        self.assertTrue(datafile.reads * 4 < len(records))
+        t.close()
+
+    def test_scan(self):
+        t = sgbd2.load_from_file(self.path + ".pickle")
+        t.reset_stats()
+        self.assertEqual([r.key for r in t.scan()], range(1, 30001))
+        self.assertTrue(t._buf._datafile.reads * 2 < t._buf.misses)
+        t.close()
+
+
+class PartitionedTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "pt")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_load(self):
+        pt = sgbd2.PartitionedTree(self.path, bounds=[500, 1000])
+        for key in xrange(1, 1500, 3):
+            pt.insert(key, "desc {0}".format(key))
+        pt.close()
+        pt = sgbd2.PartitionedTree.load(self.path)
+        self.assertEqual(len(pt), 3)
+        self.assertEqual(pt.bounds, [500, 1000])
+        self.assertEqual(pt.count(), 500)
+        self.assertEqual(pt.lookup(1000).desc, "desc 1000")
+        pt.close()
+
+    def test_sync_only_dirty(self):
+        pt = sgbd2.PartitionedTree(self.path, bounds=[500], processes=2)
+        for key in xrange(1, 1000, 3):
+            pt.insert(key, "desc {0}".format(key))
+        pt.sync()
+        clean = pt._trees[0]
+        pt.update(700, "new")
+        self.assertEqual([(r.key, r.desc) for r in pt.multi_get([1, 700])],
+                         [(1, "desc 1"), (700, "new")])
+        self.assertTrue(pt._trees[0] is clean)
+        self.assertEqual(len(pt.scan(1, 10)), 4)
+        self.assertTrue(pt._trees[0] is clean)
+        pt.close()
+
+    def test_delete(self):
+        pt = sgbd2.PartitionedTree(self.path, partitions=3)
+        for key in xrange(1, 100):
+            pt.insert(key, "desc {0}".format(key))
+        self.assertTrue(pt.delete(50))
+        self.assertFalse(pt.delete(50))
+        self.assertEqual(pt.lookup(50), None)
+        self.assertEqual(pt.multi_get([49, 50])[1], None)
+        self.assertEqual(pt.multi_get([49, 50])[0].desc, "desc 49")
+        records = pt.scan(40, 60)
+        self.assertTrue(all(isinstance(r, sgbd2.Record) for r in records))
+        self.assertEqual([r.key for r in records],
+                         [k for k in xrange(40, 61) if k != 50])
+        self.assertEqual(pt.count(), 98)
+        pt.close()
+
+
+if __name__ == "__main__":
+    unittest.main()